@@ -0,0 +1,180 @@
+# Offline throughput benchmark. Replays a directory of recorded eye clips (video files or .etvr recordings from
+# Camera.start_recording) through EyeProcessor as fast as it can go (no GUI, no camera pacing, no OSC) and writes
+# frames/sec, per stage latency percentiles, peak RSS and detection rate for every clip out as JSON, so runs from
+# different commits can be compared.
+#
+# python benchmark.py path/to/clips --output bench.json [--config eyetrack_settings.json] [--eye right]
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from queue import Queue
+from threading import Event
+import cv2
+# osc has to come in before config, config and osc import each other.
+from osc import EyeId
+from channels import PreviewChannel
+from config import EyeTrackConfig
+from eye_processor import EyeProcessor, InformationOrigin
+from frame_recorder import RECORDING_EXTENSION, open_capture
+from stage_timing import StageTimer
+
+try:
+    import resource
+except ImportError:
+    # Windows doesn't have resource, we just won't report memory there.
+    resource = None
+
+CLIP_EXTENSIONS = (".mp4", ".avi", ".mkv", ".mov", ".webm", RECORDING_EXTENSION)
+
+
+class ResultSink(Queue):
+    # Stands in for the OSC queue. We only count results, so there's no reason to keep them around.
+    def _put(self, item):
+        pass
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes.
+    if sys.platform == "darwin":
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+def find_clips(clip_dir):
+    return sorted(
+        os.path.join(clip_dir, name)
+        for name in os.listdir(clip_dir)
+        if name.lower().endswith(CLIP_EXTENSIONS)
+    )
+
+
+def benchmark_clip(path, main_config: EyeTrackConfig, eye_id: EyeId, max_frames=None):
+    # Recordings are replayed as fast as we can read them, not with their original timing.
+    capture = open_capture(path, realtime=False)
+    if not capture.isOpened():
+        print(f"[ERROR] Could not open clip {path}")
+        return None
+
+    # Work on copies so a run can never end up writing anything back to the settings file.
+    settings = main_config.settings.copy()
+    settings.timing_log_interval = 0
+    if eye_id == EyeId.RIGHT:
+        config = main_config.right_eye.copy()
+    else:
+        config = main_config.left_eye.copy()
+    # Clips are usually already cropped to the eye. If there's no ROI set up, use the whole frame.
+    if config.roi_window_w <= 0 or config.roi_window_h <= 0:
+        config.roi_window_x = 0
+        config.roi_window_y = 0
+        config.roi_window_w = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        config.roi_window_h = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+    processor = EyeProcessor(config, settings, Event(), None, PreviewChannel(), ResultSink(), eye_id)
+    # Keep every sample for the whole clip rather than the rolling window the live timers use.
+    processor.stage_timer = StageTimer(os.path.basename(path), window=None)
+
+    frames = 0
+    detected = 0
+    processing_time = 0.0
+    wall_start = time.perf_counter()
+    while max_frames is None or frames < max_frames:
+        ret, image = capture.read()
+        if not ret:
+            break
+        capture_time = time.perf_counter()
+        frame = (image, capture.get(cv2.CAP_PROP_POS_FRAMES), capture.get(cv2.CAP_PROP_FPS), capture_time)
+        eye_info = processor.process_frame(frame)
+        processing_time += time.perf_counter() - capture_time
+        frames += 1
+        if eye_info is not None and eye_info.info_type != InformationOrigin.FAILURE and not eye_info.blink:
+            detected += 1
+    wall_time = time.perf_counter() - wall_start
+    capture.release()
+
+    return {
+        "clip": os.path.basename(path),
+        "frames": frames,
+        # Processing fps leaves out decoding the clip, wall fps includes it.
+        "fps": frames / processing_time if processing_time > 0 else 0,
+        "wall_fps": frames / wall_time if wall_time > 0 else 0,
+        "detection_rate": detected / frames if frames > 0 else 0,
+        # Working image (re)allocations over the whole clip. Should stay at the handful needed for the first frame.
+        "buffer_allocations": processor.buffers.allocations,
+        # Peak for the whole process up to the end of this clip.
+        "peak_rss_mb": peak_rss_mb(),
+        "stages_ms": {
+            stage: {"p50": p50 * 1000, "p95": p95 * 1000, "p99": p99 * 1000}
+            for stage, (p50, p95, p99) in processor.stage_timer.percentiles().items()
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded eye clips through EyeProcessor and time it.")
+    parser.add_argument("clip_dir", help="directory of recorded eye clips")
+    parser.add_argument("--output", default="benchmark_results.json", help="where to write the JSON results")
+    parser.add_argument("--config", default=None, help="settings file to take ROI/threshold/etc. from")
+    parser.add_argument("--eye", choices=["right", "left"], default="right", help="which eye's settings to use")
+    parser.add_argument("--max-frames", type=int, default=None, help="stop each clip after this many frames")
+    args = parser.parse_args()
+
+    if args.config is not None:
+        with open(args.config, "r") as settings_file:
+            main_config = EyeTrackConfig(**json.load(settings_file))
+    else:
+        main_config = EyeTrackConfig()
+    eye_id = EyeId.RIGHT if args.eye == "right" else EyeId.LEFT
+
+    clips = find_clips(args.clip_dir)
+    if len(clips) == 0:
+        print(f"[ERROR] No clips found in {args.clip_dir}")
+        return
+
+    results = []
+    for path in clips:
+        print(f"[INFO] Benchmarking {path}")
+        result = benchmark_clip(path, main_config, eye_id, args.max_frames)
+        if result is None:
+            continue
+        print(
+            f"[INFO] {result['clip']}: {result['frames']} frames, {result['fps']:.1f} fps, "
+            f"{result['detection_rate'] * 100:.1f}% detected"
+        )
+        results.append(result)
+
+    with open(args.output, "w+") as output_file:
+        json.dump(
+            obj={
+                "revision": git_revision(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "opencv": cv2.__version__,
+                "ransac_fitter": main_config.settings.ransac_fitter,
+                "ransac_iterations": main_config.settings.ransac_iterations,
+                "reference_ransac_iterations": main_config.settings.reference_ransac_iterations,
+                "ransac_workers": main_config.settings.ransac_workers,
+                "ransac_time_budget": main_config.settings.ransac_time_budget,
+                "clips": results,
+            },
+            fp=output_file,
+            indent=2,
+        )
+    print(f"[INFO] Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+import numpy as np
+
+
+class BufferPool:
+    # Per eye working images, handed to OpenCV as dst= so the tracking loop writes into the same memory every
+    # frame instead of allocating fresh images. Each buffer is backed by flat storage that only ever grows, and
+    # is handed out as a contiguous view of the size asked for. Smaller requests (e.g. the search window
+    # shrinking) reuse what's there, it's only reallocated when something bigger than before is asked for.
+    #
+    # Every (re)allocation is counted, overall and for the current frame, so it's easy to check that a steady
+    # state frame doesn't allocate any working images at all.
+    def __init__(self):
+        self.buffers = {}
+        self.allocations = 0
+        self.frame_allocations = 0
+
+    def begin_frame(self):
+        self.frame_allocations = 0
+
+    def get(self, name, shape, dtype=np.uint8):
+        size = int(np.prod(shape))
+        storage = self.buffers.get(name)
+        if storage is None or storage.size < size or storage.dtype != dtype:
+            storage = self.buffers[name] = np.empty(size, dtype=dtype)
+            self.allocations += 1
+            self.frame_allocations += 1
+        return storage[:size].reshape(shape)
+
+    def like(self, name, image):
+        return self.get(name, image.shape, image.dtype)
+
+    def clear(self):
+        self.buffers.clear()
@@ -1,7 +1,12 @@
 from config import EyeTrackConfig
+from channels import FrameRing
+from stage_timing import StageTimer
+from frame_recorder import FrameRecorder, is_recording, open_capture
 from enum import Enum
 import threading
 import queue
+import os.path
+import time
 import cv2
 
 WAIT_TIME = 0.1
@@ -19,9 +24,9 @@ class Camera:
         config: EyeTrackConfig,
         camera_index: int,
         cancellation_event: "threading.Event",
-        capture_event: "threading.Event",
         camera_status_outgoing: "queue.Queue[CameraState]",
-        camera_output_outgoing: "queue.Queue",
+        camera_output_outgoing: "FrameRing",
+        stage_timer: "StageTimer" = None,
     ):
         self.camera_status = CameraState.CONNECTING
         self.config = config
@@ -29,19 +34,36 @@ class Camera:
         self.camera_address = config.capture_source
         self.camera_status_outgoing = camera_status_outgoing
         self.camera_output_outgoing = camera_output_outgoing
-        self.capture_event = capture_event
         self.cancellation_event = cancellation_event
+        self.stage_timer = stage_timer
         self.current_capture_source = config.capture_source
         self.wired_camera: "cv2.VideoCapture" = None
         self.error_message = "Capture source {} not found, retrying"
+        self.last_frame_time = 0
+        self.recorder: "FrameRecorder" = None
 
-    def set_output_queue(self, camera_output_outgoing: "queue.Queue"):
+    def set_output_queue(self, camera_output_outgoing: "FrameRing"):
         self.camera_output_outgoing = camera_output_outgoing
 
+    def start_recording(self, path):
+        # Record every frame we capture from here on, see frame_recorder.py for the format. Point a capture
+        # source at the resulting .etvr file to replay it.
+        self.stop_recording()
+        print(f"[INFO] Recording capture source {self.config.capture_source} to {path}")
+        self.recorder = FrameRecorder(path)
+
+    def stop_recording(self):
+        recorder = self.recorder
+        self.recorder = None
+        if recorder is not None:
+            recorder.close()
+            print(f"[INFO] Recorded {recorder.frames} frames to {recorder.header_path}")
+
     def run(self):
         while True:
             if self.cancellation_event.is_set():
                 print("Exiting capture thread")
+                self.stop_recording()
                 return
             should_push = True
             # If things aren't open, retry until they are. Don't let read requests come in any earlier
@@ -61,19 +83,17 @@ class Camera:
                     if self.cancellation_event.wait(WAIT_TIME):
                         return
                     self.current_capture_source = self.config.capture_source
-                    self.wired_camera = cv2.VideoCapture(self.current_capture_source)
+                    self.wired_camera = open_capture(self.current_capture_source)
                     should_push = False
             else:
                 # We don't have a capture source to try yet, wait for one to show up in the GUI.
                 if self.cancellation_event.wait(WAIT_TIME):
                     self.camera_status = CameraState.DISCONNECTED
                     return
-            # Assuming we can access our capture source, wait for another thread to request a capture.
-            # Cycle every so often to see if our cancellation token has fired. This basically uses a
-            # python event as a contextless, resettable one-shot channel.
-            if should_push and not self.capture_event.wait(timeout=0.02):
                 continue
 
+            # Always capture, as fast as the camera gives us frames. The newest frame overwrites the oldest one in
+            # the ring.
             self.get_wired_camera_picture(should_push)
             if not should_push:
                 # if we get all the way down here, consider ourselves connected
@@ -81,14 +101,21 @@ class Camera:
 
     def get_wired_camera_picture(self, should_push):
         try:
+            read_start = time.perf_counter()
             ret, image = self.wired_camera.read()
             if not ret:
                 self.wired_camera.set(cv2.CAP_PROP_POS_FRAMES, 0)
                 raise RuntimeError("Problem while getting frame")
+            capture_time = time.perf_counter()
+            if self.stage_timer is not None:
+                # This includes waiting on the camera for the next frame, not just decoding it.
+                self.stage_timer.record("capture", capture_time - read_start)
             frame_number = self.wired_camera.get(cv2.CAP_PROP_POS_FRAMES)
             fps = self.wired_camera.get(cv2.CAP_PROP_FPS)
             if should_push:
-                self.push_image_to_queue(image, frame_number, fps)
+                self.record_frame(image, frame_number, fps, capture_time)
+                self.push_image_to_queue(image, frame_number, fps, capture_time)
+                self.wait_for_file_frame(fps, capture_time)
         except:
             print(
                 "Capture source problem, assuming camera disconnected, waiting for reconnect."
@@ -96,13 +123,29 @@ class Camera:
             self.camera_status = CameraState.DISCONNECTED
             pass
 
-    def push_image_to_queue(self, image, frame_number, fps):
-        # If there's backpressure, just yell. We really shouldn't have this unless we start getting
-        # some sort of capture event conflict though.
-        qsize = self.camera_output_outgoing.qsize()
-        if qsize > 1:
-            print(
-                f"CAPTURE QUEUE BACKPRESSURE OF {qsize}. CHECK FOR CRASH OR TIMING ISSUES IN ALGORITHM."
-            )
-        self.camera_output_outgoing.put((image, frame_number, fps))
-        self.capture_event.clear()
+    def record_frame(self, image, frame_number, fps, capture_time):
+        recorder = self.recorder
+        if recorder is None:
+            return
+        try:
+            recorder.write(image, frame_number, fps, capture_time)
+        except (OSError, ValueError):
+            print("[ERROR] Could not write frame to recording, stopping recording.")
+            self.stop_recording()
+
+    def wait_for_file_frame(self, fps, capture_time):
+        # Cameras and streams hand us frames at their own pace, but video files would be decoded as fast as we
+        # can read them now that nobody is asking for frames. Play those back at their recorded frame rate.
+        # Our own recordings already replay with their original timing.
+        if not isinstance(self.current_capture_source, str) or not os.path.isfile(self.current_capture_source):
+            return
+        if is_recording(self.current_capture_source):
+            return
+        if fps > 0:
+            self.cancellation_event.wait(max(0, self.last_frame_time + 1 / fps - capture_time))
+        self.last_frame_time = time.perf_counter()
+
+    def push_image_to_queue(self, image, frame_number, fps, capture_time):
+        # The ring never backs up, if the algorithm falls behind the oldest unread frame is simply dropped and
+        # counted in camera_output_outgoing.dropped.
+        self.camera_output_outgoing.put(image, frame_number, fps, capture_time)
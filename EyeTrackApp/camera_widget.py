@@ -7,13 +7,17 @@ from enum import Enum
 from queue import Queue, Empty
 from camera import Camera, CameraState
 from osc import EyeId
+from channels import FrameRing, Notifier, PreviewChannel
+from eye_process import EyeProcess
+from stage_timing import get_stage_timer
+import time
 import cv2
 from winsound import PlaySound, SND_FILENAME, SND_ASYNC
 import traceback
 
 
 class CameraWidget:
-    def __init__(self, widget_id: EyeId, main_config: EyeTrackConfig, osc_queue: Queue):
+    def __init__(self, widget_id: EyeId, main_config: EyeTrackConfig, osc_queue: Queue, notifier: Notifier = None):
         self.gui_camera_addr = f"-CAMERAADDR{widget_id}-"
         self.gui_threshold_slider = f"-THREADHOLDSLIDER{widget_id}-"
         self.gui_rotation_slider = f"-ROTATIONSLIDER{widget_id}-"
@@ -132,37 +136,48 @@ class CameraWidget:
         self.cancellation_event = Event()
         # Set the event until start is called, otherwise we can block if shutdown is called.
         self.cancellation_event.set()
-        self.capture_event = Event()
-        self.capture_queue = Queue()
-        self.roi_queue = Queue()
-
-        self.image_queue = Queue()
-
-        self.ransac = EyeProcessor(
-            self.config,
-            self.settings_config,
-            self.cancellation_event,
-            self.capture_event,
-            self.capture_queue,
-            self.image_queue,
-            self.eye_id,
-        )
-
-        self.camera_status_queue = Queue()
-        self.camera = Camera(
-            self.config,
-            0,
-            self.cancellation_event,
-            self.capture_event,
-            self.camera_status_queue,
-            self.capture_queue,
-        )
+        self.capture_ring = FrameRing()
+        self.roi_ring = FrameRing()
+
+        if self.settings.multiprocess_eyes:
+            # Capture and processing live in their own process, the EyeProcess stands in for both of them here
+            # and previews come out of its shared memory.
+            self.eye_process = EyeProcess(self.eye_id, self.config, self.settings_config, self.osc_queue, notifier)
+            self.ransac = self.eye_process
+            self.camera = self.eye_process
+            self.preview = self.eye_process.preview_reader
+            self.roi_ring = self.eye_process.preview_reader
+        else:
+            self.eye_process = None
+            # Only the latest preview is worth drawing, tracking results go to OSC directly from the processor.
+            self.preview = PreviewChannel(notifier)
+
+            self.ransac = EyeProcessor(
+                self.config,
+                self.settings_config,
+                self.cancellation_event,
+                self.capture_ring,
+                self.preview,
+                self.osc_queue,
+                self.eye_id,
+            )
+
+            self.camera_status_queue = Queue()
+            self.camera = Camera(
+                self.config,
+                0,
+                self.cancellation_event,
+                self.camera_status_queue,
+                self.capture_ring,
+                get_stage_timer(self.eye_id.name),
+            )
 
         self.x0, self.y0 = None, None
         self.x1, self.y1 = None, None
         self.figure = None
         self.is_mouse_up = True
         self.in_roi_mode = False
+        self.last_roi_draw_time = 0
 
     def started(self):
         return not self.cancellation_event.is_set()
@@ -172,6 +187,9 @@ class CameraWidget:
         if not self.cancellation_event.is_set():
             return
         self.cancellation_event.clear()
+        if self.eye_process is not None:
+            self.eye_process.start()
+            return
         self.ransac_thread = Thread(target=self.ransac.run)
         self.ransac_thread.start()
         self.camera_thread = Thread(target=self.camera.run)
@@ -182,6 +200,9 @@ class CameraWidget:
         if self.cancellation_event.is_set():
             return
         self.cancellation_event.set()
+        if self.eye_process is not None:
+            self.eye_process.stop()
+            return
         self.ransac_thread.join()
         self.camera_thread.join()
 
@@ -221,14 +242,20 @@ class CameraWidget:
         if event == self.gui_tracking_button:
             print("Moving to tracking mode")
             self.in_roi_mode = False
-            self.camera.set_output_queue(self.capture_queue)
+            if self.eye_process is not None:
+                self.eye_process.set_roi_mode(False)
+            else:
+                self.camera.set_output_queue(self.capture_ring)
             window[self.gui_roi_layout].update(visible=False)
             window[self.gui_tracking_layout].update(visible=True)
 
         if event == self.gui_roi_button:
             print("Move to roi mode")
             self.in_roi_mode = True
-            self.camera.set_output_queue(self.roi_queue)
+            if self.eye_process is not None:
+                self.eye_process.set_roi_mode(True)
+            else:
+                self.camera.set_output_queue(self.roi_ring)
             window[self.gui_roi_layout].update(visible=True)
             window[self.gui_tracking_layout].update(visible=False)
 
@@ -274,10 +301,13 @@ class CameraWidget:
             window[self.gui_mode_readout].update("Tracking")
 
         if self.in_roi_mode:
-            try:
-                if self.roi_queue.empty():
-                    self.capture_event.set()
-                maybe_image = self.roi_queue.get(block=False)
+            # Tracking previews are rate capped by the processor, cropping previews are capped here.
+            maybe_image = None
+            preview_fps = self.settings.preview_fps
+            if preview_fps <= 0 or time.perf_counter() - self.last_roi_draw_time >= 1 / preview_fps:
+                maybe_image = self.roi_ring.wait_for_frame(timeout=0)
+            if maybe_image is not None:
+                self.last_roi_draw_time = time.perf_counter()
                 imgbytes = cv2.imencode(".ppm", maybe_image[0])[1].tobytes()
                 graph = window[self.gui_roi_selection]
                 if self.figure:
@@ -291,8 +321,6 @@ class CameraWidget:
                     self.figure = graph.draw_rectangle(
                         (self.x0, self.y0), (self.x1, self.y1), line_color="#6f4ca1"
                     )
-            except Empty:
-                pass
         else:
             if needs_roi_set:
                 window[self.gui_roi_message].update(visible=True)
@@ -301,8 +329,12 @@ class CameraWidget:
             try:
                 window[self.gui_roi_message].update(visible=False)
                 window[self.gui_output_graph].update(visible=True)
-                (maybe_image, eye_info) = self.image_queue.get(block=False)
-                imgbytes = cv2.imencode(".ppm", maybe_image)[1].tobytes()
+                preview = self.preview.read()
+                if preview is None:
+                    raise Empty
+                (maybe_image, eye_info) = preview
+                # The preview is gray and threshold side by side in a single gray image, which Tk takes as a PGM.
+                imgbytes = cv2.imencode(".pgm", maybe_image)[1].tobytes()
                 window[self.gui_tracking_image].update(data=imgbytes)
 
                 # Update the GUI
@@ -325,8 +357,5 @@ class CameraWidget:
                     graph.update(background_color="#6f4ca1")
                 elif eye_info.info_type == InformationOrigin.FAILURE:
                     graph.update(background_color="red")
-                # Relay information to OSC
-                if eye_info.info_type != InformationOrigin.FAILURE:
-                    self.osc_queue.put((self.eye_id, eye_info))
             except Empty:
                 pass
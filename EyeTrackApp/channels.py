@@ -0,0 +1,271 @@
+from dataclasses import dataclass
+from enum import Enum
+from multiprocessing import shared_memory
+import queue
+import threading
+import time
+import numpy as np
+
+# Size of a shared frame slot to start with: a 1080p BGR camera frame, or two 1080p gray planes side by side.
+# Eye processes ask for a bigger slot when their frames don't fit, see SharedPreview.
+SHARED_FRAME_MAX_BYTES = 1920 * 1080 * 3
+SHARED_FRAME_HEADER = np.dtype(
+    [
+        ("sequence", np.uint64),
+        ("read_time", np.float64),
+        ("height", np.uint32),
+        ("width", np.uint32),
+        ("channels", np.uint32),
+    ]
+)
+# Previews are only produced while someone has asked for one within this many seconds.
+PREVIEW_SUBSCRIBER_TIMEOUT = 0.5
+
+
+def preview_wanted(read_time, publish_time, max_fps):
+    # Whether a preview is worth producing right now: someone is reading them and the capped preview rate (0 or
+    # less means uncapped) allows another one.
+    now = time.perf_counter()
+    if now - read_time > PREVIEW_SUBSCRIBER_TIMEOUT:
+        return False
+    return max_fps <= 0 or now - publish_time >= 1 / max_fps
+
+
+class ControlCommand(Enum):
+    SETTINGS_CHANGED = 1
+
+
+@dataclass
+class ControlMessage:
+    command: ControlCommand
+    # None means the message is for every eye.
+    eye_id: object = None
+
+
+class ControlChannel:
+    # Settings changes and commands, kept apart from the gaze results going to OSC. Every subscriber gets its
+    # own queue, and nothing is put on them unless something actually happened, so an idle settings page costs
+    # nothing.
+    def __init__(self):
+        self.subscribers = []
+        self.lock = threading.Lock()
+
+    def subscribe(self) -> "queue.Queue[ControlMessage]":
+        subscriber = queue.Queue()
+        with self.lock:
+            self.subscribers.append(subscriber)
+        return subscriber
+
+    def publish(self, message: ControlMessage):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.put(message)
+
+
+class Notifier:
+    # Wakes the GUI up when the pipeline has something new for it. However many times notify() is called, the
+    # callback only runs once until the GUI calls clear(), so a fast camera can't pile up events behind a slow
+    # GUI.
+    def __init__(self):
+        self.callback = None
+        self.pending = False
+        self.lock = threading.Lock()
+
+    def set_callback(self, callback):
+        with self.lock:
+            self.callback = callback
+            self.pending = False
+
+    def notify(self):
+        with self.lock:
+            if self.pending or self.callback is None:
+                return
+            self.pending = True
+            callback = self.callback
+        callback()
+
+    def clear(self):
+        with self.lock:
+            self.pending = False
+
+
+class FrameRing:
+    # Fixed set of preallocated frame buffers shared between a Camera and whoever is reading from it. The camera
+    # always writes into a slot that nobody is looking at and then publishes it as the newest frame, so the
+    # reader always gets the latest frame and anything it didn't get to in time is counted as dropped instead of
+    # piling up.
+    #
+    # The buffer returned from wait_for_frame stays untouched until the next wait_for_frame call, which is why we
+    # need at least three slots: the one being read, the newest one, and the one being written.
+    def __init__(self, slots=3):
+        if slots < 3:
+            raise ValueError("FrameRing needs at least 3 slots")
+        self.buffers = [None] * slots
+        self.frame_info = [None] * slots
+        self.condition = threading.Condition()
+        self.next_slot = 0
+        self.latest_slot = None
+        self.reading_slot = None
+        self.sequence = 0
+        self.read_sequence = 0
+        self.dropped = 0
+
+    def put(self, image, frame_number, fps, capture_time):
+        with self.condition:
+            slot = self.next_slot
+            while slot == self.latest_slot or slot == self.reading_slot:
+                slot = (slot + 1) % len(self.buffers)
+            self.next_slot = (slot + 1) % len(self.buffers)
+
+        # Only reallocate when the capture source changes shape on us, otherwise just copy into the slot.
+        buffer = self.buffers[slot]
+        if buffer is None or buffer.shape != image.shape or buffer.dtype != image.dtype:
+            buffer = self.buffers[slot] = np.empty_like(image)
+        np.copyto(buffer, image)
+
+        with self.condition:
+            if self.sequence != self.read_sequence:
+                # The last frame was never picked up, the reader has fallen behind.
+                self.dropped += 1
+            self.frame_info[slot] = (frame_number, fps, capture_time)
+            self.latest_slot = slot
+            self.sequence += 1
+            self.condition.notify_all()
+
+    def wait_for_frame(self, timeout=None):
+        # Returns (image, frame_number, fps, capture_time) for the newest frame we haven't handed out yet, or
+        # None if nothing new showed up within the timeout.
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.sequence != self.read_sequence, timeout):
+                return None
+            self.reading_slot = self.latest_slot
+            self.read_sequence = self.sequence
+            frame_number, fps, capture_time = self.frame_info[self.reading_slot]
+            return self.buffers[self.reading_slot], frame_number, fps, capture_time
+
+
+class PreviewChannel:
+    # Hands preview images from the processing thread to the GUI. The processor checks wanted() before doing any
+    # preview work at all, so hidden and headless eyes (nobody reading) and frames above the preview rate cost
+    # nothing. The gray and threshold planes are copied straight into one preallocated side by side buffer,
+    # there's no color conversion or concatenating on the processing thread. The reader gets its own copy to
+    # encode, and only when there's something new.
+    def __init__(self, notifier: "Notifier" = None):
+        self.notifier = notifier
+        self.lock = threading.Lock()
+        self.buffer = None
+        self.eye_info = None
+        self.sequence = 0
+        self.read_sequence = 0
+        self.read_time = float("-inf")
+        self.publish_time = float("-inf")
+
+    def wanted(self, max_fps):
+        return preview_wanted(self.read_time, self.publish_time, max_fps)
+
+    def publish(self, gray, threshold, eye_info):
+        rows, cols = gray.shape
+        with self.lock:
+            if self.buffer is None or self.buffer.shape != (rows, cols * 2):
+                self.buffer = np.empty((rows, cols * 2), dtype=np.uint8)
+            self.buffer[:, :cols] = gray
+            self.buffer[:, cols:] = threshold
+            self.eye_info = eye_info
+            self.sequence += 1
+        self.publish_time = time.perf_counter()
+        if self.notifier is not None:
+            self.notifier.notify()
+
+    def read(self):
+        # Returns (image, eye_info) if there's a preview we haven't seen yet, otherwise None. Calling this is also
+        # what tells the processor someone is watching.
+        self.read_time = time.perf_counter()
+        with self.lock:
+            if self.sequence == self.read_sequence:
+                return None
+            self.read_sequence = self.sequence
+            return self.buffer.copy(), self.eye_info
+
+
+class SharedFrame:
+    # A single uint8 frame slot in shared memory, for handing images from one process to another without pickling
+    # them. A small header in front of the pixels holds the shape of the latest frame and a sequence number that
+    # is bumped on every write. The (multiprocessing) lock keeps readers from seeing half written frames.
+    #
+    # The creating side passes name=None and is responsible for unlink(), the other side attaches by name.
+    def __init__(self, lock, name=None, size=SHARED_FRAME_MAX_BYTES):
+        if name is None:
+            self.memory = shared_memory.SharedMemory(create=True, size=SHARED_FRAME_HEADER.itemsize + size)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.name = self.memory.name
+        self.lock = lock
+        self.header = np.ndarray((1,), dtype=SHARED_FRAME_HEADER, buffer=self.memory.buf)
+        self.pixels = np.ndarray(
+            (self.memory.size - SHARED_FRAME_HEADER.itemsize,),
+            dtype=np.uint8,
+            buffer=self.memory.buf,
+            offset=SHARED_FRAME_HEADER.itemsize,
+        )
+        self.read_sequence = 0
+
+    @property
+    def size(self):
+        return self.pixels.size
+
+    def write_planes(self, gray, threshold):
+        # Same side by side layout as PreviewChannel, written straight into shared memory.
+        rows, cols = gray.shape
+        if rows * cols * 2 > self.pixels.size:
+            return False
+        with self.lock:
+            stack = self.pixels[: rows * cols * 2].reshape((rows, cols * 2))
+            stack[:, :cols] = gray
+            stack[:, cols:] = threshold
+            self.header["height"] = rows
+            self.header["width"] = cols * 2
+            self.header["channels"] = 1
+            self.header["sequence"] += 1
+        return True
+
+    def write(self, image):
+        if image.nbytes > self.pixels.size:
+            return False
+        channels = 1 if image.ndim == 2 else image.shape[2]
+        with self.lock:
+            self.pixels[: image.nbytes] = image.reshape(-1)
+            self.header["height"] = image.shape[0]
+            self.header["width"] = image.shape[1]
+            self.header["channels"] = channels
+            self.header["sequence"] += 1
+        return True
+
+    def read(self):
+        # Returns a copy of the newest frame, or None if nothing was written since the last read. Also lets the
+        # writing side know someone is reading, see read_time().
+        self.header["read_time"] = time.perf_counter()
+        with self.lock:
+            sequence = int(self.header["sequence"][0])
+            if sequence == self.read_sequence:
+                return None
+            height = int(self.header["height"][0])
+            width = int(self.header["width"][0])
+            channels = int(self.header["channels"][0])
+            image = self.pixels[: height * width * channels].copy()
+        self.read_sequence = sequence
+        if channels == 1:
+            return image.reshape((height, width))
+        return image.reshape((height, width, channels))
+
+    def read_time(self):
+        return float(self.header["read_time"][0])
+
+    def close(self):
+        # Our numpy views have to go before the memory can be closed.
+        self.header = None
+        self.pixels = None
+        self.memory.close()
+
+    def unlink(self):
+        self.memory.unlink()
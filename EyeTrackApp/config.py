@@ -1,9 +1,15 @@
-from typing import Union, Dict
+from typing import Union, Dict, List, Optional
 from osc import EyeId
+import atexit
 import os.path
 import json
+import tempfile
+import threading
+import time
 from pydantic import BaseModel
 CONFIG_FILE_NAME: str = "eyetrack_settings.json"
+# How long the config has to be left alone before a save actually hits the disk.
+SAVE_DEBOUNCE: float = 0.5
 
 
 class EyeTrackCameraConfig(BaseModel):
@@ -16,6 +22,7 @@ class EyeTrackCameraConfig(BaseModel):
     focal_length: int = 30
     capture_source: Union[int, str, None] = None
     gui_circular_crop: bool = False
+    pupil_engine: str = "ransac"
 
 
 class EyeTrackSettingsConfig(BaseModel):
@@ -36,6 +43,41 @@ class EyeTrackSettingsConfig(BaseModel):
     gui_eye_falloff: bool = False
     tracker_single_eye: int = 0
     gui_blink_sync: bool = False
+    ransac_fitter: str = "batched"
+    # RANSAC hypotheses per frame for the batched and parallel fitters. The reference fitter is a lot slower per
+    # hypothesis and has its own count, reference_ransac_iterations.
+    ransac_iterations: int = 100
+    reference_ransac_iterations: int = 5
+    ransac_workers: int = 0
+    ransac_time_budget: float = 0.0
+    timing_log_interval: float = 30
+    multiprocess_eyes: bool = False
+    preview_fps: int = 30
+    search_window: bool = True
+    search_window_margin: int = 20
+    osc_bundles: bool = True
+    osc_resend_interval: float = 1.0
+    osc_send_rate: int = 90
+    osc_extrapolate: bool = False
+    osc_max_staleness: float = 0.1
+    gui_refresh_rate: int = 60
+    adaptive_quality: bool = False
+    frame_deadline: float = 0.0
+    pipeline_workers: int = 0
+    pipeline_log_interval: float = 5
+
+
+class EyeTrackPipelineConfig(BaseModel):
+    # One camera of one of the extra headsets run by the PipelineManager (pipeline_manager.py). Pipelines with
+    # the same OSC target and namespace are treated as the two eyes of the same headset.
+    name: str = ""
+    eye: EyeId = EyeId.RIGHT
+    camera: EyeTrackCameraConfig = EyeTrackCameraConfig()
+    # Left unset, these fall back on gui_osc_address and gui_osc_port.
+    osc_address: Optional[str] = None
+    osc_port: Optional[int] = None
+    # Put in front of every OSC address this pipeline sends to, e.g. "/rig2".
+    osc_namespace: str = ""
 
 
 class EyeTrackConfig(BaseModel):
@@ -44,6 +86,7 @@ class EyeTrackConfig(BaseModel):
     left_eye: EyeTrackCameraConfig = EyeTrackCameraConfig()
     settings: EyeTrackSettingsConfig = EyeTrackSettingsConfig()
     eye_display_id: EyeId = EyeId.RIGHT
+    pipelines: List[EyeTrackPipelineConfig] = []
 
     @staticmethod
     def load():
@@ -54,5 +97,106 @@ class EyeTrackConfig(BaseModel):
             return EyeTrackConfig(**json.load(settings_file))
 
     def save(self):
-        with open(CONFIG_FILE_NAME, "w+") as settings_file:
-            json.dump(obj=self.dict(), fp=settings_file)
+        # Doesn't write anything itself, see ConfigWriter.
+        config_writer.save(self)
+
+
+class ConfigWriter:
+    # Saving the config used to rewrite the settings file right there on the GUI thread, on every change, so a
+    # slider drag could write it dozens of times a second. Now save() only takes a snapshot and marks it dirty,
+    # and a background thread writes it out once nothing has changed for SAVE_DEBOUNCE seconds. Files are
+    # written to a temp file next to the settings file and renamed over it, so a crash mid-write can't leave
+    # a half written settings file behind.
+    #
+    # save() is also where everyone else finds out the config changed: listeners added with add_listener are
+    # called (on the saving thread) with the config every time, so nobody needs to poll fields to spot changes.
+    def __init__(self, path=CONFIG_FILE_NAME, debounce=SAVE_DEBOUNCE):
+        self.path = path
+        self.debounce = debounce
+        self.condition = threading.Condition()
+        # Writes are numbered, so a flush and the background thread racing each other can't end with an older
+        # snapshot on disk.
+        self.write_lock = threading.Lock()
+        self.sequence = 0
+        self.written_sequence = 0
+        self.pending = None
+        self.changed_time = 0
+        self.thread = None
+        self.listeners = []
+
+    def add_listener(self, listener):
+        with self.condition:
+            self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self.condition:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+
+    def save(self, config: "EyeTrackConfig"):
+        snapshot = config.dict()
+        with self.condition:
+            self.sequence += 1
+            self.pending = (self.sequence, snapshot)
+            self.changed_time = time.perf_counter()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener(config)
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending is not None)
+                # Keep pushing the write back while changes keep coming in.
+                while True:
+                    remaining = self.changed_time + self.debounce - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+            self.write_pending()
+
+    def flush(self):
+        # Write out anything that hasn't been yet, right now. If the background thread is already writing, this
+        # waits for it to finish.
+        self.write_pending()
+
+    def write_pending(self):
+        # pending is only ever taken while holding write_lock, so once a flush gets the lock nothing can be
+        # sitting between being taken and being written. Always write_lock first, then condition.
+        with self.write_lock:
+            with self.condition:
+                pending = self.pending
+                self.pending = None
+            if pending is None:
+                return
+            sequence, snapshot = pending
+            if sequence <= self.written_sequence:
+                return
+            self.write_file(snapshot)
+            self.written_sequence = sequence
+
+    def write_file(self, snapshot):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            with tempfile.NamedTemporaryFile(
+                "w", dir=directory, prefix=".eyetrack_settings", suffix=".tmp", delete=False
+            ) as settings_file:
+                json.dump(obj=snapshot, fp=settings_file)
+                settings_file.flush()
+                os.fsync(settings_file.fileno())
+            os.replace(settings_file.name, self.path)
+        except OSError:
+            print("[ERROR] Could not save settings.")
+            try:
+                os.remove(settings_file.name)
+            except (OSError, NameError):
+                pass
+
+
+config_writer = ConfigWriter()
+# Don't lose the last few changes on the way out.
+atexit.register(config_writer.flush)
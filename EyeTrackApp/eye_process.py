@@ -0,0 +1,348 @@
+import multiprocessing
+import queue
+import threading
+import time
+from camera import Camera, CameraState
+from channels import FrameRing, Notifier, SharedFrame, preview_wanted
+from config import EyeTrackCameraConfig, EyeTrackSettingsConfig, config_writer
+from eye_processor import EyeProcessor, InformationOrigin
+from osc import EyeId
+from stage_timing import get_stage_timer
+
+# How often the eye process reports its state.
+STATE_INTERVAL = 0.1
+# How often the eye process looks for a new cropping preview while the GUI is in ROI mode.
+ROI_PREVIEW_INTERVAL = 0.02
+
+
+class SharedPreview:
+    # The eye process' end of the shared preview slot. The slot starts out sized for 1080p, so frames from bigger
+    # cameras won't fit: we then ask the parent for a bigger slot (it owns them all) and drop frames until it
+    # has been attached. Slots that are swapped out stay open until the process exits, as the processing thread
+    # may still be writing to one.
+    def __init__(self, lock: "multiprocessing.Lock", name: str, result_queue: "multiprocessing.Queue"):
+        self.lock = lock
+        self.frame = SharedFrame(lock, name)
+        self.result_queue = result_queue
+        self.retired = []
+        self.requested_size = 0
+
+    def read_time(self):
+        return self.frame.read_time()
+
+    def write(self, image):
+        if not self.frame.write(image):
+            self.request_size(image.nbytes)
+
+    def write_planes(self, gray, threshold):
+        if not self.frame.write_planes(gray, threshold):
+            self.request_size(gray.size * 2)
+
+    def request_size(self, size):
+        if size <= self.requested_size:
+            return
+        self.requested_size = size
+        print(f"[INFO] Preview frame of {size} bytes doesn't fit the {self.frame.size} byte preview slot, growing it")
+        self.result_queue.put(("preview_size", size))
+
+    def attach(self, name):
+        self.retired.append(self.frame)
+        self.frame = SharedFrame(self.lock, name)
+
+    def close(self):
+        for frame in self.retired + [self.frame]:
+            frame.close()
+
+
+class PreviewSink:
+    # Stands in for the PreviewChannel inside the eye process. The planes are written straight into shared
+    # memory, only failures (which never make it to the OSC queue) are sent back so the GUI can still show them.
+    def __init__(self, preview: SharedPreview, result_queue: "multiprocessing.Queue"):
+        self.preview = preview
+        self.result_queue = result_queue
+        self.publish_time = float("-inf")
+
+    def wanted(self, max_fps):
+        return preview_wanted(self.preview.read_time(), self.publish_time, max_fps)
+
+    def publish(self, gray, threshold, eye_info):
+        self.preview.write_planes(gray, threshold)
+        self.publish_time = time.perf_counter()
+        if eye_info.info_type == InformationOrigin.FAILURE:
+            self.result_queue.put(("info", eye_info))
+
+
+class ResultSink:
+    # Stands in for the OSC queue inside the eye process.
+    def __init__(self, result_queue: "multiprocessing.Queue"):
+        self.result_queue = result_queue
+
+    def put(self, item, block=True, timeout=None):
+        eye_id, eye_info = item
+        self.result_queue.put(("result", eye_info))
+
+
+def update_model(model, values):
+    for field, value in values.items():
+        setattr(model, field, value)
+
+
+def run_eye_process(
+    eye_id: EyeId,
+    config: EyeTrackCameraConfig,
+    settings: EyeTrackSettingsConfig,
+    cancellation_event: "multiprocessing.Event",
+    control_queue: "multiprocessing.Queue",
+    result_queue: "multiprocessing.Queue",
+    preview_name: str,
+    preview_lock: "multiprocessing.Lock",
+):
+    # Entry point of the eye process. Capture and processing run on their own threads here exactly like they do
+    # in the GUI process, so frames never leave this process. This thread handles control messages from the
+    # parent and reports state back.
+    preview = SharedPreview(preview_lock, preview_name, result_queue)
+    capture_ring = FrameRing()
+    roi_ring = FrameRing()
+    threads_cancellation_event = threading.Event()
+
+    processor = EyeProcessor(
+        config,
+        settings,
+        threads_cancellation_event,
+        capture_ring,
+        PreviewSink(preview, result_queue),
+        ResultSink(result_queue),
+        eye_id,
+    )
+    camera = Camera(
+        config,
+        0,
+        threads_cancellation_event,
+        queue.Queue(),
+        capture_ring,
+        get_stage_timer(eye_id.name),
+    )
+    threads = [threading.Thread(target=processor.run), threading.Thread(target=camera.run)]
+    for thread in threads:
+        thread.start()
+
+    roi_mode = False
+    recenter_requested = settings.gui_recenter_eyes
+    last_state = None
+    while not cancellation_event.is_set():
+        try:
+            message = control_queue.get(timeout=ROI_PREVIEW_INTERVAL if roi_mode else STATE_INTERVAL)
+        except queue.Empty:
+            message = None
+
+        if message is not None:
+            kind = message[0]
+            if kind == "config":
+                _, config_values, settings_values = message
+                update_model(config, config_values)
+                # The processor clears recentering here when it's done, so only start it when the parent asks
+                # for it again rather than every time its (not yet cleared) copy comes down.
+                recenter = settings_values.pop("gui_recenter_eyes")
+                update_model(settings, settings_values)
+                processor.on_config_change()
+                if recenter and not recenter_requested:
+                    settings.gui_recenter_eyes = True
+                recenter_requested = recenter
+            elif kind == "calibrate":
+                processor.calibration_frame_counter = message[1]
+            elif kind == "roi_mode":
+                roi_mode = message[1]
+                camera.set_output_queue(roi_ring if roi_mode else capture_ring)
+            elif kind == "record":
+                camera.start_recording(message[1])
+            elif kind == "preview":
+                preview.attach(message[1])
+
+        if roi_mode:
+            frame = roi_ring.wait_for_frame(timeout=0)
+            if frame is not None:
+                preview.write(frame[0])
+
+        state = (processor.calibration_frame_counter, camera.camera_status, settings.gui_recenter_eyes)
+        if state != last_state:
+            result_queue.put(("state",) + state)
+            last_state = state
+
+    threads_cancellation_event.set()
+    for thread in threads:
+        thread.join()
+    preview.close()
+
+
+class PreviewReader:
+    # Reads previews out of the eye process' shared memory, with the same calls CameraWidget makes on its
+    # PreviewChannel (tracking mode) and ROI frame ring (cropping mode).
+    def __init__(self, eye_process: "EyeProcess"):
+        self.eye_process = eye_process
+
+    def read(self):
+        image = self.read_image()
+        if image is None or self.eye_process.eye_info is None:
+            return None
+        return image, self.eye_process.eye_info
+
+    def wait_for_frame(self, timeout=None):
+        image = self.read_image()
+        if image is None:
+            return None
+        return image, 0, 0, 0
+
+    def read_image(self):
+        preview = self.eye_process.preview
+        if preview is None:
+            return None
+        return preview.read()
+
+
+class EyeProcess:
+    # Runs one eye's Camera and EyeProcessor in a process of their own, so the two eyes and the GUI aren't all
+    # taking turns on the same GIL. Turned on with settings.multiprocess_eyes.
+    #
+    # From the outside this looks enough like the EyeProcessor and Camera pair it replaces that the GUI, headless
+    # mode and the OSC receiver don't need to care: calibration_frame_counter, camera_status and start_recording
+    # are forwarded to/from the eye process, config changes are picked up and sent down automatically, results
+    # land on the OSC queue and previews are read through preview_reader.
+    def __init__(
+        self,
+        eye_id: EyeId,
+        config: EyeTrackCameraConfig,
+        settings: EyeTrackSettingsConfig,
+        osc_queue,
+        notifier: Notifier = None,
+    ):
+        self.eye_id = eye_id
+        self.config = config
+        self.settings = settings
+        self.osc_queue = osc_queue
+        self.notifier = notifier
+
+        self.cancellation_event = multiprocessing.Event()
+        self.cancellation_event.set()
+        self.control_queue = multiprocessing.Queue()
+        self.result_queue = multiprocessing.Queue()
+        self.preview_lock = multiprocessing.Lock()
+        self.preview: "SharedFrame" = None
+        # Slots replaced by bigger ones, kept until stop as the GUI or the eye process may still be using them.
+        self.retired_previews = []
+        self.preview_reader = PreviewReader(self)
+        self.process: "multiprocessing.Process" = None
+        self.forward_thread: "threading.Thread" = None
+        self.config_changed = threading.Event()
+
+        self.eye_info = None
+        self.calibration_counter = None
+        self.camera_status = CameraState.CONNECTING
+        self.recentering = False
+        self.roi_mode = False
+
+    @property
+    def calibration_frame_counter(self):
+        return self.calibration_counter
+
+    @calibration_frame_counter.setter
+    def calibration_frame_counter(self, value):
+        self.calibration_counter = value
+        self.control_queue.put(("calibrate", value))
+
+    def set_roi_mode(self, roi_mode):
+        self.roi_mode = roi_mode
+        self.control_queue.put(("roi_mode", roi_mode))
+
+    def start_recording(self, path):
+        self.control_queue.put(("record", path))
+
+    def started(self):
+        return not self.cancellation_event.is_set()
+
+    def start(self):
+        if not self.cancellation_event.is_set():
+            return
+        self.cancellation_event.clear()
+        self.preview = SharedFrame(self.preview_lock)
+        self.camera_status = CameraState.CONNECTING
+        self.process = multiprocessing.Process(
+            target=run_eye_process,
+            args=(
+                self.eye_id,
+                self.config,
+                self.settings,
+                self.cancellation_event,
+                self.control_queue,
+                self.result_queue,
+                self.preview.name,
+                self.preview_lock,
+            ),
+            daemon=True,
+        )
+        self.process.start()
+        if self.roi_mode:
+            self.control_queue.put(("roi_mode", True))
+        config_writer.add_listener(self.on_config_change)
+        self.forward_thread = threading.Thread(target=self.forward_results)
+        self.forward_thread.start()
+
+    def stop(self):
+        if self.cancellation_event.is_set():
+            return
+        self.cancellation_event.set()
+        config_writer.remove_listener(self.on_config_change)
+        self.forward_thread.join()
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            print(f"[WARN] {self.eye_id.name} eye process didn't exit, terminating it")
+            self.process.terminate()
+        self.process = None
+        previews = self.retired_previews + [self.preview]
+        self.preview = None
+        self.retired_previews = []
+        for preview in previews:
+            preview.close()
+            preview.unlink()
+
+    def grow_preview(self, size):
+        # The eye process' frames don't fit the preview slot, swap in a big enough one.
+        if size <= self.preview.size:
+            return
+        self.retired_previews.append(self.preview)
+        self.preview = SharedFrame(self.preview_lock, size=size)
+        self.control_queue.put(("preview", self.preview.name))
+
+    def on_config_change(self, main_config):
+        self.config_changed.set()
+
+    def forward_results(self):
+        # Config goes down to the eye process whenever it's saved. Recentering is requested without a save, so
+        # that one flag is watched on its own.
+        sent_recenter = self.settings.gui_recenter_eyes
+        while not self.cancellation_event.is_set():
+            if self.config_changed.is_set() or self.settings.gui_recenter_eyes != sent_recenter:
+                self.config_changed.clear()
+                sent_recenter = self.settings.gui_recenter_eyes
+                self.control_queue.put(("config", self.config.dict(), self.settings.dict()))
+
+            try:
+                message = self.result_queue.get(timeout=STATE_INTERVAL)
+            except queue.Empty:
+                continue
+
+            kind = message[0]
+            if kind == "result":
+                self.eye_info = message[1]
+                self.osc_queue.put((self.eye_id, message[1]))
+            elif kind == "info":
+                self.eye_info = message[1]
+            elif kind == "preview_size":
+                self.grow_preview(message[1])
+            elif kind == "state":
+                _, self.calibration_counter, self.camera_status, recentering = message
+                # The eye process finished recentering, clear the request so it isn't sent again.
+                if self.recentering and not recentering:
+                    self.settings.gui_recenter_eyes = False
+                self.recentering = recentering
+            if self.notifier is not None:
+                self.notifier.notify()
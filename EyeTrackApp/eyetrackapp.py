@@ -1,8 +1,11 @@
+import multiprocessing
 import os
+import time
 from osc import VRChatOSCReceiver, VRChatOSC, EyeId
 from config import EyeTrackConfig
 from camera_widget import CameraWidget
 from settings_widget import SettingsWidget
+from channels import ControlChannel, Notifier
 import queue
 import threading
 import PySimpleGUI as sg
@@ -28,6 +31,10 @@ LEFT_EYE_RADIO_NAME = "-LEFTEYERADIO-"
 RIGHT_EYE_RADIO_NAME = "-RIGHTEYERADIO-"
 BOTH_EYE_RADIO_NAME = "-BOTHEYERADIO-"
 SETTINGS_RADIO_NAME = '-SETTINGSRADIO-'
+# Posted by the pipeline (through the Notifier) when there's a new preview or result to show.
+PIPELINE_EVENT_NAME = "-PIPELINEUPDATE-"
+# With nothing happening we still come around this often, for camera status and the like.
+IDLE_TIMEOUT_MS = 250
 
 
 page_url = 'https://github.com/RedHawk989/EyeTrackVR/releases/latest'
@@ -85,18 +92,22 @@ def main():
 
     # Spawn worker threads
     osc_queue: queue.Queue[tuple[bool, int, int]] = queue.Queue()
-    osc = VRChatOSC(cancellation_event, osc_queue, config)
+    # Settings changes and commands, kept off the gaze results queue.
+    control_channel = ControlChannel()
+    osc = VRChatOSC(cancellation_event, osc_queue, config, control_channel)
     osc_thread = threading.Thread(target=osc.run)
     # start worker threads
     osc_thread.start()
 
+    # Lets the eyes wake the GUI up when they have something new to show, instead of it polling them.
+    notifier = Notifier()
     eyes = [
-        CameraWidget(EyeId.RIGHT, config, osc_queue),
-        CameraWidget(EyeId.LEFT, config, osc_queue),
+        CameraWidget(EyeId.RIGHT, config, osc_queue, notifier),
+        CameraWidget(EyeId.LEFT, config, osc_queue, notifier),
     ]
 
     settings = [
-        SettingsWidget(EyeId.SETTINGS, config, osc_queue),
+        SettingsWidget(EyeId.SETTINGS, config, control_channel),
     ]
 
     layout = [
@@ -169,12 +180,25 @@ def main():
     osc_receiver_thread.start()
 
     # Create the window
-    window = sg.Window(f"EyeTrackVR {appversion}" , layout, icon='Images/logo.ico', background_color='#292929')
-
-    # GUI Render loop
+    window = sg.Window(
+        f"EyeTrackVR {appversion}", layout, icon='Images/logo.ico', background_color='#292929', finalize=True
+    )
+    notifier.set_callback(lambda: window.write_event_value(PIPELINE_EVENT_NAME, None))
+
+    # GUI Render loop. We sleep until there's a UI event or the pipeline tells us there's something new to
+    # show, and never redraw faster than gui_refresh_rate.
+    last_render = 0
     while True:
+        # Cropping mode shows raw camera frames, which don't notify us, so keep ticking while it's up.
+        if any(eye.started() and eye.in_roi_mode for eye in eyes) and config.settings.gui_refresh_rate > 0:
+            timeout = int(1000 / config.settings.gui_refresh_rate)
+        else:
+            timeout = IDLE_TIMEOUT_MS
+
         # First off, check for any events from the GUI
-        event, values = window.read(timeout=1)
+        event, values = window.read(timeout=timeout)
+        if event == PIPELINE_EVENT_NAME:
+            notifier.clear()
 
         # If we're in either mode and someone hits q, quit immediately
         if event == "Exit" or event == sg.WIN_CLOSED:
@@ -241,7 +265,17 @@ def main():
                 eye.render(window, event, values)
         settings[0].render(window, event, values)
 
+        # Hold off on the next redraw if we're above the refresh rate, whatever comes in meanwhile is picked up
+        # on the next read.
+        if config.settings.gui_refresh_rate > 0:
+            remaining = last_render + 1 / config.settings.gui_refresh_rate - time.perf_counter()
+            if remaining > 0:
+                time.sleep(remaining)
+            last_render = time.perf_counter()
+
 
 if __name__ == "__main__":
+    # Needed for the per eye processes (settings.multiprocess_eyes) in frozen Windows builds.
+    multiprocessing.freeze_support()
     main()
     
\ No newline at end of file
@@ -0,0 +1,147 @@
+import json
+import os.path
+import threading
+import time
+import numpy as np
+import cv2
+
+# A recording is three files sharing a name: the .etvr header (JSON, frame shape and dtype), the .raw frames
+# (uncompressed, back to back, so they can be memory mapped) and the .idx index (frame number, fps and capture
+# time per frame as float64). Point a capture source at the .etvr file to replay it.
+RECORDING_EXTENSION = ".etvr"
+INDEX_FIELDS = 3
+
+
+def is_recording(source):
+    return isinstance(source, str) and source.lower().endswith(RECORDING_EXTENSION)
+
+
+def recording_paths(path):
+    base, extension = os.path.splitext(path)
+    if extension.lower() != RECORDING_EXTENSION:
+        base = path
+    return base + RECORDING_EXTENSION, base + ".raw", base + ".idx"
+
+
+def open_capture(source, realtime=True):
+    # Drop in for cv2.VideoCapture that also understands our own recordings.
+    if is_recording(source):
+        try:
+            return FrameReplay(source, realtime)
+        except (OSError, ValueError, KeyError):
+            print(f"[ERROR] Could not open recording {source}")
+            # Not opened, so whoever asked will treat it like any other missing capture source.
+            return cv2.VideoCapture()
+    return cv2.VideoCapture(source)
+
+
+class FrameRecorder:
+    # Records raw frames exactly as the camera gave them to us, along with the frame number, fps and capture
+    # timestamp that the rest of the pipeline (and pye3d) relies on. Everything is appended as we go, so a
+    # crash only costs us the frame being written.
+    def __init__(self, path):
+        self.header_path, self.raw_path, self.index_path = recording_paths(path)
+        self.raw_file = None
+        self.index_file = None
+        self.shape = None
+        self.dtype = None
+        self.frames = 0
+        self.lock = threading.Lock()
+
+    def write(self, image, frame_number, fps, capture_time):
+        with self.lock:
+            if self.raw_file is None:
+                self.shape = image.shape
+                self.dtype = image.dtype
+                with open(self.header_path, "w+") as header_file:
+                    json.dump(obj={"version": 1, "shape": list(self.shape), "dtype": self.dtype.str}, fp=header_file)
+                self.raw_file = open(self.raw_path, "wb")
+                self.index_file = open(self.index_path, "wb")
+            elif image.shape != self.shape or image.dtype != self.dtype:
+                # Raw frames are fixed size, so we can't keep going if the camera changes resolution on us.
+                raise ValueError("Frame shape changed while recording")
+
+            # Frame first, then its index entry, so the index never points past the end of the frame data.
+            np.ascontiguousarray(image).tofile(self.raw_file)
+            np.array([frame_number, fps, capture_time], dtype=np.float64).tofile(self.index_file)
+            self.frames += 1
+
+    def close(self):
+        with self.lock:
+            if self.raw_file is not None:
+                self.raw_file.close()
+                self.index_file.close()
+                self.raw_file = None
+                self.index_file = None
+
+
+class FrameReplay:
+    # Serves a recording back through the same isOpened/read/get/set/release calls Camera makes on
+    # cv2.VideoCapture. In realtime mode frames are handed out with the spacing they were captured with,
+    # otherwise as fast as they're asked for. Frame numbers and fps are the recorded ones, so pye3d sees exactly
+    # the same timestamps it did live.
+    def __init__(self, path, realtime=True):
+        header_path, raw_path, index_path = recording_paths(path)
+        with open(header_path, "r") as header_file:
+            header = json.load(header_file)
+        self.shape = tuple(header["shape"])
+        self.dtype = np.dtype(header["dtype"])
+        index = np.fromfile(index_path, dtype=np.float64).reshape(-1, INDEX_FIELDS)
+
+        frame_size = int(np.prod(self.shape)) * self.dtype.itemsize
+        count = min(len(index), os.path.getsize(raw_path) // frame_size)
+        self.index = index[:count]
+        self.frames = None
+        if count > 0:
+            self.frames = np.memmap(raw_path, dtype=self.dtype, mode="r", shape=(count,) + self.shape)
+
+        self.realtime = realtime
+        self.position = 0
+        self.replay_start = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def isOpened(self):
+        return self.frames is not None
+
+    def read(self):
+        if self.frames is None or self.position >= len(self.index):
+            return False, None
+
+        if self.realtime:
+            recorded_offset = self.index[self.position, 2] - self.index[0, 2]
+            if self.replay_start is None:
+                self.replay_start = time.perf_counter() - recorded_offset
+            delay = self.replay_start + recorded_offset - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        # Copy out of the map, consumers are free to hang on to the frame or write into it.
+        image = np.array(self.frames[self.position])
+        self.position += 1
+        return True, image
+
+    def get(self, prop):
+        last = max(self.position - 1, 0)
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return self.index[last, 0] if self.position > 0 else 0
+        if prop == cv2.CAP_PROP_FPS:
+            return self.index[last, 1] if len(self.index) > 0 else 0
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return len(self.index)
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.shape[1]
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.shape[0]
+        return 0
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            self.position = int(value)
+            self.replay_start = None
+            return True
+        return False
+
+    def release(self):
+        self.frames = None
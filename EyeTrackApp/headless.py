@@ -0,0 +1,188 @@
+import argparse
+import multiprocessing
+import os
+import time
+from osc import VRChatOSCReceiver, VRChatOSC, EyeId
+from config import EyeTrackConfig
+from eye_processor import EyeProcessor
+from camera import Camera
+from channels import FrameRing, PreviewChannel
+from eye_process import EyeProcess
+from pipeline_manager import PipelineManager
+from stage_timing import get_stage_timer
+from threading import Event, Thread
+from queue import Queue
+
+# Random environment variable to speed up webcam opening on the MSMF backend.
+# https://github.com/opencv/opencv/issues/17687
+os.environ["OPENCV_VIDEOIO_MSMF_ENABLE_HW_TRANSFORMS"] = "0"
+
+
+class HeadlessEye:
+    # Same Camera -> EyeProcessor wiring as CameraWidget, without any of the GUI. The processor publishes results
+    # straight on to the OSC queue, and preview images are never picked up or encoded.
+    def __init__(self, eye_id: EyeId, main_config: EyeTrackConfig, osc_queue: Queue):
+        self.eye_id = eye_id
+        self.main_config = main_config
+        self.settings = main_config.settings
+        if self.eye_id == EyeId.RIGHT:
+            self.config = main_config.right_eye
+        elif self.eye_id == EyeId.LEFT:
+            self.config = main_config.left_eye
+        else:
+            raise RuntimeError("Cannot have a headless eye represent both eyes!")
+        self.osc_queue = osc_queue
+
+        self.cancellation_event = Event()
+        # Set the event until start is called, otherwise we can block if shutdown is called.
+        self.cancellation_event.set()
+        self.capture_ring = FrameRing()
+        # Never read, so the processor never spends anything on previews.
+        self.preview = PreviewChannel()
+
+        if self.settings.multiprocess_eyes:
+            # See CameraWidget, the EyeProcess stands in for both the processor and the camera.
+            self.eye_process = EyeProcess(self.eye_id, self.config, self.settings, self.osc_queue)
+            self.ransac = self.eye_process
+            self.camera = self.eye_process
+            return
+        self.eye_process = None
+
+        self.ransac = EyeProcessor(
+            self.config,
+            self.settings,
+            self.cancellation_event,
+            self.capture_ring,
+            self.preview,
+            self.osc_queue,
+            self.eye_id,
+        )
+
+        self.camera_status_queue = Queue()
+        self.camera = Camera(
+            self.config,
+            0,
+            self.cancellation_event,
+            self.camera_status_queue,
+            self.capture_ring,
+            get_stage_timer(self.eye_id.name),
+        )
+
+    def has_capture_source(self):
+        return self.config.capture_source is not None and self.config.capture_source != ""
+
+    def started(self):
+        return not self.cancellation_event.is_set()
+
+    def start(self):
+        # If we're already running, bail
+        if not self.cancellation_event.is_set():
+            return
+        self.cancellation_event.clear()
+        if self.eye_process is not None:
+            self.eye_process.start()
+            return
+        self.ransac_thread = Thread(target=self.ransac.run)
+        self.ransac_thread.start()
+        self.camera_thread = Thread(target=self.camera.run)
+        self.camera_thread.start()
+
+    def stop(self):
+        # If we're not running yet, bail
+        if self.cancellation_event.is_set():
+            return
+        self.cancellation_event.set()
+        if self.eye_process is not None:
+            self.eye_process.stop()
+            return
+        self.ransac_thread.join()
+        self.camera_thread.join()
+
+
+def run_pipelines(config: EyeTrackConfig):
+    # With pipelines set up in the config we run those (any number of cameras/headsets, see PipelineManager)
+    # instead of the usual right and left eye.
+    manager = PipelineManager(config)
+    if len(manager.pipelines) == 0:
+        print("[ERROR] None of the configured pipelines have a capture source set.")
+        return
+    manager.start()
+    print("[INFO] Headless tracking running. Ctrl+C to exit.")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    manager.stop()
+    print("Exiting EyeTrackApp")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run eye tracking without the GUI.")
+    parser.add_argument("--record", default=None, help="directory to record raw frames from each eye into")
+    args = parser.parse_args()
+
+    # Get Configuration. Unlike the GUI we never write this back out, the settings file is managed elsewhere.
+    config: EyeTrackConfig = EyeTrackConfig.load()
+
+    if len(config.pipelines) > 0:
+        run_pipelines(config)
+        return
+
+    cancellation_event = Event()
+    osc_queue: Queue[tuple[bool, int, int]] = Queue()
+
+    eyes = [
+        HeadlessEye(EyeId.RIGHT, config, osc_queue),
+        HeadlessEye(EyeId.LEFT, config, osc_queue),
+    ]
+    active_eyes = [eye for eye in eyes if eye.has_capture_source()]
+    if len(active_eyes) == 0:
+        print("[ERROR] No capture source set for either eye. Set one up in eyetrack_settings.json or the GUI first.")
+        return
+
+    # Mirror what the eye selection radio in the GUI does for single eye setups.
+    if len(active_eyes) == 2:
+        config.settings.tracker_single_eye = 0
+    elif active_eyes[0].eye_id == EyeId.RIGHT:
+        config.settings.tracker_single_eye = 2
+    else:
+        config.settings.tracker_single_eye = 1
+
+    # Spawn worker threads
+    osc = VRChatOSC(cancellation_event, osc_queue, config)
+    osc_thread = Thread(target=osc.run)
+    osc_thread.start()
+
+    for eye in active_eyes:
+        if args.record is not None:
+            os.makedirs(args.record, exist_ok=True)
+            eye.camera.start_recording(
+                os.path.join(args.record, f"{eye.eye_id.name.lower()}_{time.strftime('%Y%m%d_%H%M%S')}")
+            )
+        eye.start()
+
+    osc_receiver = VRChatOSCReceiver(cancellation_event, config, active_eyes)
+    osc_receiver_thread = Thread(target=osc_receiver.run)
+    osc_receiver_thread.start()
+
+    print(f"[INFO] Headless tracking running for {', '.join(eye.eye_id.name for eye in active_eyes)}. Ctrl+C to exit.")
+    try:
+        while not cancellation_event.wait(1):
+            pass
+    except KeyboardInterrupt:
+        pass
+
+    for eye in active_eyes:
+        eye.stop()
+    cancellation_event.set()
+    osc_thread.join()
+    osc_receiver.shutdown()
+    osc_receiver_thread.join()
+    print("Exiting EyeTrackApp")
+
+
+if __name__ == "__main__":
+    # Needed for the per eye processes (settings.multiprocess_eyes) in frozen Windows builds.
+    multiprocessing.freeze_support()
+    main()
@@ -1,8 +1,10 @@
+import math
+import time
 import numpy as np
-from time import time
+
 
 def smoothing_factor(t_e, cutoff):
-    r = 2 * np.pi * cutoff * t_e
+    r = 2 * math.pi * cutoff * t_e
     return r / (r + 1)
 
 
@@ -11,41 +13,75 @@ def exponential_smoothing(a, x, x_prev):
 
 
 class OneEuroFilter:
+    # Filters any number of channels at once (x, y, pupil, openness, ...), each with its own state. The state is
+    # kept as plain floats: for the handful of channels we filter, that's a lot cheaper than setting up numpy
+    # arrays on every call, and nothing is allocated per sample apart from the returned tuple.
+    #
+    # Samples are filtered against the timestamp they're given (the frame's capture time), not the time the
+    # filter happens to get called, so processing jitter doesn't leak into the output.
     def __init__(self, x0, dx0=0.0, min_cutoff=1.0, beta=0.0,
                  d_cutoff=1.0):
-        """Initialize the one euro filter."""
+        """Initialize the one euro filter. x0 is a starting value per channel, or a single number."""
         # The parameters.
-        self.data_shape = x0.shape
-        self.min_cutoff = np.full(x0.shape, min_cutoff)
-        self.beta = np.full(x0.shape, beta)
-        self.d_cutoff = np.full(x0.shape, d_cutoff)
+        self.data_shape = np.shape(x0)
+        self.channels = int(np.size(x0))
+        self.min_cutoff = float(min_cutoff)
+        self.beta = float(beta)
+        self.d_cutoff = float(d_cutoff)
         # Previous values.
-        self.x_prev = x0.astype(np.float)
-        self.dx_prev = np.full(x0.shape, dx0)
-        self.t_prev = time()
+        self.x_prev = [float(v) for v in np.ravel(x0)]
+        self.dx_prev = [float(dx0)] * self.channels
+        self.t_prev = None
+
+    def __call__(self, x, t=None):
+        """Filter a single sample taken at time t (seconds, defaults to now). Returns a tuple, one value per channel."""
+        if isinstance(x, np.ndarray):
+            x = x.tolist()
+        elif not isinstance(x, (list, tuple)):
+            x = [x]
+        assert len(x) == self.channels
+        if t is None:
+            t = time.perf_counter()
+        return self.filter_values(x, t)
 
-    def __call__(self, x):
-        """Compute the filtered signal."""
-        assert x.shape == self.data_shape
+    def filter_values(self, x, t):
+        if self.t_prev is None:
+            # First sample, nothing to smooth against yet.
+            self.x_prev = [float(v) for v in x]
+            self.t_prev = t
+            return tuple(self.x_prev)
 
-        t = time()
         t_e = t - self.t_prev
-        if t_e != 0.0: #occasionally when switching to algos this becomes zero causing divide by zero errors crashing the filter.
-                t_e = np.full(x.shape, t_e)
+        if t_e <= 0.0:
+            # Same (or an older) timestamp as the last sample, e.g. a repeated frame or switching algos. There's
+            # nothing to filter, and dividing by it would blow the filter up.
+            return tuple(self.x_prev)
+
+        # The filtered derivative of the signal.
+        a_d = smoothing_factor(t_e, self.d_cutoff)
+        for i in range(self.channels):
+            dx = (x[i] - self.x_prev[i]) / t_e
+            dx_hat = exponential_smoothing(a_d, dx, self.dx_prev[i])
 
-                # The filtered derivative of the signal.
-                a_d = smoothing_factor(t_e, self.d_cutoff)
-                dx = (x - self.x_prev) / t_e
-                dx_hat = exponential_smoothing(a_d, dx, self.dx_prev)
+            # The filtered signal.
+            cutoff = self.min_cutoff + self.beta * abs(dx_hat)
+            a = smoothing_factor(t_e, cutoff)
 
-                # The filtered signal.
-                cutoff = self.min_cutoff + self.beta * np.abs(dx_hat)
-                a = smoothing_factor(t_e, cutoff)
-                x_hat = exponential_smoothing(a, x, self.x_prev)
+            # Memorize the previous values.
+            self.x_prev[i] = exponential_smoothing(a, x[i], self.x_prev[i])
+            self.dx_prev[i] = dx_hat
+        self.t_prev = t
+        return tuple(self.x_prev)
 
-                # Memorize the previous values.
-                self.x_prev = x_hat
-                self.dx_prev = dx_hat
-                self.t_prev = t
+    def filter_batch(self, samples, timestamps):
+        """Filter a whole run of samples (one row per sample, one column per channel) with their timestamps, e.g.
+        when replaying a recording. Carries on from, and updates, the filter's current state."""
+        samples = np.asarray(samples, dtype=np.float64).reshape(len(timestamps), self.channels)
+        filtered = np.empty_like(samples)
+        for n, (sample, t) in enumerate(zip(samples.tolist(), np.asarray(timestamps, dtype=np.float64).tolist())):
+            filtered[n] = self.filter_values(sample, t)
+        return filtered
 
-                return x_hat
+    def reset(self):
+        self.t_prev = None
+        self.dx_prev = [0.0] * self.channels
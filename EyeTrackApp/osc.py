@@ -1,11 +1,16 @@
 from pythonosc import udp_client
 from pythonosc import osc_server
 from pythonosc import dispatcher
-from winsound import PlaySound, SND_FILENAME, SND_ASYNC
+from pythonosc.osc_bundle_builder import OscBundleBuilder, IMMEDIATELY
+from pythonosc.osc_message_builder import OscMessageBuilder
 import queue
 import threading
 from enum import IntEnum
+from dataclasses import replace
 import time
+import sys
+if sys.platform.startswith("win"):
+    from winsound import PlaySound, SND_FILENAME, SND_ASYNC
 
 class EyeId(IntEnum):
     RIGHT = 0
@@ -13,143 +18,362 @@ class EyeId(IntEnum):
     BOTH = 2
     SETTINGS = 3
 from config import EyeTrackConfig
+from channels import ControlChannel, ControlCommand
+from stage_timing import get_stage_timer
+
+
+def build_message(address, value):
+    builder = OscMessageBuilder(address=address)
+    builder.add_arg(value)
+    return builder.build()
+
+
+class OSCOutput:
+    # Sits where the SimpleUDPClient used to, with the same send_message call. Nothing goes out when a value is
+    # set though: writes to the same address are coalesced (last one wins) until flush(), and then everything
+    # that changed goes out as a single OSC bundle, sent from this class' own thread so tracking never waits on
+    # a socket. Values that haven't changed since they were last sent are skipped, apart from being sent again
+    # every resend_interval seconds in case a datagram got lost along the way.
+    #
+    # A namespace, if given, goes in front of every address, so several headsets can share one OSC target.
+    def __init__(
+        self,
+        cancellation_event: threading.Event,
+        address,
+        port,
+        use_bundles=True,
+        resend_interval=1.0,
+        namespace="",
+    ):
+        self.address = address
+        self.port = port
+        self.namespace = namespace
+        self.client = udp_client.SimpleUDPClient(address, port)
+        self.cancellation_event = cancellation_event
+        self.use_bundles = use_bundles
+        self.resend_interval = resend_interval
+        self.pending = {}
+        self.last_sent = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.datagrams = 0
+        # (timer name, send start, capture time) of the results in pending, see flush.
+        self.pending_timings = []
+        # last_sent belongs to the sender thread, connect only asks for it to be cleared.
+        self.reset_last_sent = False
+
+    def connect(self, address, port):
+        # Point the output somewhere else. Everything is sent again there, it has never seen any of it.
+        if (address, port) == (self.address, self.port):
+            return
+        self.address = address
+        self.port = port
+        with self.lock:
+            self.client = udp_client.SimpleUDPClient(address, port)
+            self.reset_last_sent = True
+
+    def send_message(self, address, value):
+        with self.lock:
+            self.pending[self.namespace + address] = value
+
+    def flush(self, timings=()):
+        # timings are (stage timer name, send start, capture time) for the results that went into this flush.
+        # "osc_send" and "end_to_end" are recorded for them once they've really been sent.
+        if len(timings) > 0:
+            with self.lock:
+                self.pending_timings.extend(timings)
+        self.wakeup.set()
+
+    def run(self):
+        while not self.cancellation_event.is_set():
+            if not self.wakeup.wait(0.1):
+                continue
+            self.wakeup.clear()
+            self.send_pending()
+
+    def send_pending(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            timings = self.pending_timings
+            self.pending_timings = []
+            client = self.client
+            if self.reset_last_sent:
+                self.reset_last_sent = False
+                self.last_sent = {}
+
+        self.send_messages(client, pending)
+        send_end = time.perf_counter()
+        for name, send_start, capture_time in timings:
+            stage_timer = get_stage_timer(name)
+            stage_timer.record("osc_send", send_end - send_start)
+            stage_timer.record("end_to_end", send_end - capture_time)
+
+    def send_messages(self, client, pending):
+        now = time.perf_counter()
+        messages = []
+        for address, value in pending.items():
+            last = self.last_sent.get(address)
+            if last is not None and last[0] == value and now - last[1] < self.resend_interval:
+                continue
+            self.last_sent[address] = (value, now)
+            messages.append(build_message(address, value))
+        if len(messages) == 0:
+            return
+
+        try:
+            if self.use_bundles:
+                bundle = OscBundleBuilder(IMMEDIATELY)
+                for message in messages:
+                    bundle.add_content(message)
+                client.send(bundle.build())
+                self.datagrams += 1
+            else:
+                for message in messages:
+                    client.send(message)
+                    self.datagrams += 1
+        except OSError:
+            print("[WARN] Could not send OSC data.")
+
 
 class VRChatOSC:
     # Use a tuple of blink (true, blinking, false, not), x, y for now. Probably clearer as a class but
     # we're stuck in python 3.6 so still no dataclasses. God I hate python.
-    def __init__(self, cancellation_event: threading.Event, msg_queue: queue.Queue[tuple[bool, int, int]], main_config: EyeTrackConfig,):
+    def __init__(
+        self,
+        cancellation_event: threading.Event,
+        msg_queue: queue.Queue[tuple[bool, int, int]],
+        main_config: EyeTrackConfig,
+        control_channel: ControlChannel = None,
+        namespace: str = "",
+    ):
         self.main_config = main_config
         self.config = main_config.settings
-        self.client = udp_client.SimpleUDPClient(self.config.gui_osc_address, int(self.config.gui_osc_port)) # use OSC port and address that was set in the config
+        self.client = OSCOutput(  # use OSC port and address that was set in the config
+            cancellation_event,
+            self.config.gui_osc_address,
+            int(self.config.gui_osc_port),
+            self.config.osc_bundles,
+            self.config.osc_resend_interval,
+            namespace,
+        )
         self.cancellation_event = cancellation_event
         self.msg_queue = msg_queue
-        
+        # Settings changes come in separately from the gaze results, see handle_control.
+        self.control_queue = control_channel.subscribe() if control_channel is not None else None
+        self.last_blink = time.time()
+        self.yl = 621
+        self.yr = 621
+        self.sx = 0
+        self.sy = 0
+        self.rb = False
+        self.lb = False
+        # Newest and previous result per eye, and which eyes' newest result has already been sent.
+        self.latest = {}
+        self.previous = {}
+        self.sent = set()
+
     def run(self):
-        start = time.time()
-        last_blink = time.time()
-        yl = 621
-        yr = 621
-        sx = 0 
-        sy = 0
-        se = 0
-        lec = 0
-        rec = 0
-        rb = False
-        lb = False
+        # With osc_send_rate set, results are collected as they come in and the combined state for both eyes is
+        # sent on a fixed tick, independent of either camera's frame rate. With it at 0, results go out as soon
+        # as they arrive.
+        output_thread = threading.Thread(target=self.client.run)
+        output_thread.start()
+        next_tick = time.perf_counter()
         while True:
             if self.cancellation_event.is_set():
                 print("Exiting OSC Queue")
+                output_thread.join()
                 return
+
+            self.handle_control()
+            rate = self.config.osc_send_rate
+            timeout = 0.1 if rate <= 0 else max(0.0, next_tick - time.perf_counter())
             try:
-                (eye_id, eye_info) = self.msg_queue.get(block=True, timeout=0.1)
-            except:
+                (eye_id, eye_info) = self.msg_queue.get(block=True, timeout=timeout)
+                self.receive(eye_id, eye_info)
+                # Everything that's already waiting goes out in the same tick.
+                while True:
+                    (eye_id, eye_info) = self.msg_queue.get(block=False)
+                    self.receive(eye_id, eye_info)
+            except queue.Empty:
+                pass
+
+            now = time.perf_counter()
+            if rate > 0:
+                if now < next_tick:
+                    continue
+                next_tick += 1 / rate
+                if next_tick < now:
+                    # We fell behind (or the rate changed), don't try to catch up with a burst of ticks.
+                    next_tick = now + 1 / rate
+            self.tick(now, extrapolate=rate > 0 and self.config.osc_extrapolate)
+
+    def handle_control(self):
+        if self.control_queue is None:
+            return
+        while True:
+            try:
+                message = self.control_queue.get(block=False)
+            except queue.Empty:
+                return
+            if message.command == ControlCommand.SETTINGS_CHANGED:
+                try:
+                    self.client.connect(self.config.gui_osc_address, int(self.config.gui_osc_port))
+                except (OSError, ValueError):
+                    print("[ERROR] Could not set up OSC output, check the OSC address and port.")
+                self.client.use_bundles = self.config.osc_bundles
+                self.client.resend_interval = self.config.osc_resend_interval
+
+    def receive(self, eye_id, eye_info):
+        self.previous[eye_id] = self.latest.get(eye_id)
+        self.latest[eye_id] = eye_info
+        self.sent.discard(eye_id)
+
+    def tick(self, now, extrapolate=False):
+        # Send the latest result of each eye, as long as it isn't older than osc_max_staleness. That pairs up
+        # whatever left and right results are closest to now, and sending the older one first means EyesY is
+        # averaged from the pair. Results that already went out are only sent again when extrapolating them
+        # forward to now.
+        send_start = time.perf_counter()
+        fresh = []
+        for eye_id, eye_info in self.latest.items():
+            if eye_info.capture_time and now - eye_info.capture_time > self.config.osc_max_staleness:
                 continue
+            if eye_id not in self.sent:
+                fresh.append((eye_id, eye_info))
+            elif extrapolate and not eye_info.blink:
+                fresh.append((eye_id, self.extrapolate(eye_id, eye_info, now)))
+        if len(fresh) == 0:
+            return
 
-            if not eye_info.blink:
-                if self.config.tracker_single_eye == 1 or self.config.tracker_single_eye == 2:
-                    self.client.send_message("/avatar/parameters/LeftEyeX", eye_info.x)  # only one eye is detected or there is an error. Send mirrored data to both eyes.
+        fresh.sort(key=lambda update: update[1].capture_time)
+        for (eye_id, eye_info) in fresh:
+            self.send_eye_info(eye_id, eye_info)
+        # Timings are recorded by the output once the datagram has actually gone out.
+        timings = []
+        for (eye_id, eye_info) in fresh:
+            if eye_id in self.sent:
+                continue
+            self.sent.add(eye_id)
+            if eye_info.capture_time:
+                timings.append((eye_id.name, send_start, eye_info.capture_time))
+        self.client.flush(timings)
+
+    def extrapolate(self, eye_id, eye_info, now):
+        # Carry the gaze on along its last velocity to now, never further ahead than osc_max_staleness.
+        previous = self.previous.get(eye_id)
+        if previous is None or previous.blink or previous.info_type != eye_info.info_type:
+            return eye_info
+        elapsed = eye_info.capture_time - previous.capture_time
+        if elapsed <= 0:
+            return eye_info
+        lead = min(now - eye_info.capture_time, self.config.osc_max_staleness) / elapsed
+        x = eye_info.x + (eye_info.x - previous.x) * lead
+        y = eye_info.y + (eye_info.y - previous.y) * lead
+        return replace(eye_info, x=max(-1.0, min(1.0, x)), y=max(-1.0, min(1.0, y)))
+
+    def send_eye_info(self, eye_id, eye_info):
+        if not eye_info.blink:
+            if self.config.tracker_single_eye == 1 or self.config.tracker_single_eye == 2:
+                self.client.send_message("/avatar/parameters/LeftEyeX", eye_info.x)  # only one eye is detected or there is an error. Send mirrored data to both eyes.
+                self.client.send_message("/avatar/parameters/RightEyeX", eye_info.x)
+                self.client.send_message("/avatar/parameters/EyesY", eye_info.y)
+                self.client.send_message("/avatar/parameters/RightEyeLid", float(0))# old param open right
+                self.client.send_message("/avatar/parameters/RightEyeLidExpandedSqueeze", float(0.8)) # open r
+                self.client.send_message("/avatar/parameters/LeftEyeLid", float(0))# old param open left
+                self.client.send_message("/avatar/parameters/LeftEyeLidExpandedSqueeze", float(0.8)) # open left eye
+            if self.config.gui_blink_sync and not self.rb and not self.lb:
+                self.client.send_message("/avatar/parameters/RightEyeLid", float(0))# old param open right
+                self.client.send_message("/avatar/parameters/RightEyeLidExpandedSqueeze", float(0.8)) # open r
+                self.client.send_message("/avatar/parameters/LeftEyeLid", float(0))# old param open left
+                self.client.send_message("/avatar/parameters/LeftEyeLidExpandedSqueeze", float(0.8)) # open left eye
+
+            else:
+                if eye_id in [EyeId.RIGHT]:
+                    self.yr = eye_info.y
+                    self.sx = eye_info.x
+                    self.sy = eye_info.y
+                    self.rb = False
                     self.client.send_message("/avatar/parameters/RightEyeX", eye_info.x)
-                    self.client.send_message("/avatar/parameters/EyesY", eye_info.y)
-                    self.client.send_message("/avatar/parameters/RightEyeLid", float(0))# old param open right
-                    self.client.send_message("/avatar/parameters/RightEyeLidExpandedSqueeze", float(0.8)) # open r
-                    self.client.send_message("/avatar/parameters/LeftEyeLid", float(0))# old param open left
-                    self.client.send_message("/avatar/parameters/LeftEyeLidExpandedSqueeze", float(0.8)) # open left eye
-                if self.config.gui_blink_sync and not rb and not lb:
-                    self.client.send_message("/avatar/parameters/RightEyeLid", float(0))# old param open right
-                    self.client.send_message("/avatar/parameters/RightEyeLidExpandedSqueeze", float(0.8)) # open r
-                    self.client.send_message("/avatar/parameters/LeftEyeLid", float(0))# old param open left
-                    self.client.send_message("/avatar/parameters/LeftEyeLidExpandedSqueeze", float(0.8)) # open left eye
+                    if not self.config.gui_blink_sync or self.config.gui_blink_sync and not self.lb:   
+                        self.client.send_message("/avatar/parameters/RightEyeLid", float(0))# old param open right
+                        self.client.send_message("/avatar/parameters/RightEyeLidExpandedSqueeze", float(0.8)) # open right eye
 
-                else:
-                    if eye_id in [EyeId.RIGHT]:
-                        yr = eye_info.y
-                        sx = eye_info.x
-                        sy = eye_info.y
-                        rb = False
-                        self.client.send_message("/avatar/parameters/RightEyeX", eye_info.x)
-                        if not self.config.gui_blink_sync or self.config.gui_blink_sync and not lb:   
-                            self.client.send_message("/avatar/parameters/RightEyeLid", float(0))# old param open right
-                            self.client.send_message("/avatar/parameters/RightEyeLidExpandedSqueeze", float(0.8)) # open right eye
+                if eye_id in [EyeId.LEFT]:
+                    self.yl = eye_info.y
+                    self.sx = eye_info.x
+                    self.sy = eye_info.y
+                    self.lb = False
+                    self.client.send_message("/avatar/parameters/LeftEyeX", eye_info.x)
+                    if not self.config.gui_blink_sync or self.config.gui_blink_sync and not self.rb:
+                        self.client.send_message("/avatar/parameters/LeftEyeLid", float(0))# old param open left
+                        self.client.send_message("/avatar/parameters/LeftEyeLidExpandedSqueeze", float(0.8)) # open left eye
 
-                    if eye_id in [EyeId.LEFT]:
-                        yl = eye_info.y
-                        sx = eye_info.x
-                        sy = eye_info.y
-                        lb = False
-                        self.client.send_message("/avatar/parameters/LeftEyeX", eye_info.x)
-                        if not self.config.gui_blink_sync or self.config.gui_blink_sync and not rb:
-                            self.client.send_message("/avatar/parameters/LeftEyeLid", float(0))# old param open left
-                            self.client.send_message("/avatar/parameters/LeftEyeLidExpandedSqueeze", float(0.8)) # open left eye
-
-                    if (yr != 621 and yl != 621) and (lb == False and rb == False):
-                        y = (yr + yl) / 2
-                        self.client.send_message("/avatar/parameters/EyesY", y)
+                if (self.yr != 621 and self.yl != 621) and (self.lb == False and self.rb == False):
+                    y = (self.yr + self.yl) / 2
+                    self.client.send_message("/avatar/parameters/EyesY", y)
+        else:
+            print(self.last_blink)
+            if self.config.gui_blink_sync:
+                if eye_id in [EyeId.LEFT]:
+                    self.lb = True
+                if eye_id in [EyeId.RIGHT]:
+                    self.rb = True
+                if self.rb == True and self.lb == True : # If both eyes are closed, blink
+                    if self.last_blink > 0.5:
+                        self.client.send_message("/avatar/parameters/RightEyeLid", float(1)) #close eye
+                        self.client.send_message("/avatar/parameters/LeftEyeLid", float(1))
+                        self.client.send_message("/avatar/parameters/RightEyeLidExpandedSqueeze", float(0)) # close eye
+                        self.client.send_message("/avatar/parameters/LeftEyeLidExpandedSqueeze", float(0))
+                    self.last_blink = time.time() - self.last_blink
             else:
-                print(last_blink)
-                if self.config.gui_blink_sync:
+
+                if self.config.tracker_single_eye == 1 or self.config.tracker_single_eye == 2:
+                    if self.last_blink > 0.5:
+                        self.client.send_message("/avatar/parameters/RightEyeLid", float(1)) #close eye
+                        self.client.send_message("/avatar/parameters/LeftEyeLid", float(1))
+                        self.client.send_message("/avatar/parameters/RightEyeLidExpandedSqueeze", float(0)) # close eye
+                        self.client.send_message("/avatar/parameters/LeftEyeLidExpandedSqueeze", float(0))
+                    self.last_blink = time.time() - self.last_blink
+
+                if not self.config.gui_eye_falloff:
+
                     if eye_id in [EyeId.LEFT]:
-                        lb = True
+                        self.lb = True
+                        if self.last_blink > 0.7:
+                            self.client.send_message("/avatar/parameters/LeftEyeLid", float(1))
+                            self.client.send_message("/avatar/parameters/LeftEyeLidExpandedSqueeze", float(0))
+                        self.last_blink = time.time() - self.last_blink
+
+
                     if eye_id in [EyeId.RIGHT]:
-                        rb = True
-                    if rb == True and lb == True : # If both eyes are closed, blink
-                        if last_blink > 0.5:
-                            for i in range(4):
-                                self.client.send_message("/avatar/parameters/RightEyeLid", float(1)) #close eye
-                                self.client.send_message("/avatar/parameters/LeftEyeLid", float(1))
-                                self.client.send_message("/avatar/parameters/RightEyeLidExpandedSqueeze", float(0)) # close eye
-                                self.client.send_message("/avatar/parameters/LeftEyeLidExpandedSqueeze", float(0))
-                        last_blink = time.time() - last_blink
+                        self.rb = True
+                        if self.last_blink > 0.7:
+                            self.client.send_message("/avatar/parameters/RightEyeLid", float(1))
+                            self.client.send_message("/avatar/parameters/RightEyeLidExpandedSqueeze", float(0)) # close eye
+                        self.last_blink = time.time() - self.last_blink
+
                 else:
-                    
-                    if self.config.tracker_single_eye == 1 or self.config.tracker_single_eye == 2:
-                        if last_blink > 0.5:
-                            for i in range(4):
-                                self.client.send_message("/avatar/parameters/RightEyeLid", float(1)) #close eye
-                                self.client.send_message("/avatar/parameters/LeftEyeLid", float(1))
-                                self.client.send_message("/avatar/parameters/RightEyeLidExpandedSqueeze", float(0)) # close eye
-                                self.client.send_message("/avatar/parameters/LeftEyeLidExpandedSqueeze", float(0))
-                        last_blink = time.time() - last_blink
-
-                    if not self.config.gui_eye_falloff:
-                        
-                        if eye_id in [EyeId.LEFT]:
-                            lb = True
-                            if last_blink > 0.7:
-                                for i in range(5):
-                                    self.client.send_message("/avatar/parameters/LeftEyeLid", float(1))
-                                    self.client.send_message("/avatar/parameters/LeftEyeLidExpandedSqueeze", float(0))
-                            last_blink = time.time() - last_blink
-
-
-                        if eye_id in [EyeId.RIGHT]:
-                            rb = True
-                            if last_blink > 0.7:
-                                for i in range(5):
-                                    self.client.send_message("/avatar/parameters/RightEyeLid", float(1))
-                                    self.client.send_message("/avatar/parameters/RightEyeLidExpandedSqueeze", float(0)) # close eye
-                            last_blink = time.time() - last_blink
-
-                    else:
-                        if eye_id in [EyeId.LEFT]:
-                            lb = True
-                        if eye_id in [EyeId.RIGHT]:
-                            rb = True
-                        if rb or lb: # If one eye closed and fall off is enabled, mirror data
-                            self.client.send_message("/avatar/parameters/LeftEyeX", sx)  #Send mirrored data to both eyes.
-                            self.client.send_message("/avatar/parameters/RightEyeX", sx)
-                            self.client.send_message("/avatar/parameters/EyesY", sy)
-                            self.client.send_message("/avatar/parameters/RightEyeLid", float(0))# old param open right
-                            self.client.send_message("/avatar/parameters/RightEyeLidExpandedSqueeze", float(0.8)) # open r
-                            self.client.send_message("/avatar/parameters/LeftEyeLid", float(0))# old param open left
-                            self.client.send_message("/avatar/parameters/LeftEyeLidExpandedSqueeze", float(0.8)) # open left eye
-                        if rb and lb: # If both eyes are closed, blink
-                            if last_blink > 0.5:
-                                for i in range(4):
-                                    self.client.send_message("/avatar/parameters/RightEyeLid", float(1)) #close eye
-                                    self.client.send_message("/avatar/parameters/LeftEyeLid", float(1))
-                                    self.client.send_message("/avatar/parameters/RightEyeLidExpandedSqueeze", float(0)) # close eye
-                                    self.client.send_message("/avatar/parameters/LeftEyeLidExpandedSqueeze", float(0))
-                            last_blink = time.time() - last_blink
+                    if eye_id in [EyeId.LEFT]:
+                        self.lb = True
+                    if eye_id in [EyeId.RIGHT]:
+                        self.rb = True
+                    if self.rb or self.lb: # If one eye closed and fall off is enabled, mirror data
+                        self.client.send_message("/avatar/parameters/LeftEyeX", self.sx)  #Send mirrored data to both eyes.
+                        self.client.send_message("/avatar/parameters/RightEyeX", self.sx)
+                        self.client.send_message("/avatar/parameters/EyesY", self.sy)
+                        self.client.send_message("/avatar/parameters/RightEyeLid", float(0))# old param open right
+                        self.client.send_message("/avatar/parameters/RightEyeLidExpandedSqueeze", float(0.8)) # open r
+                        self.client.send_message("/avatar/parameters/LeftEyeLid", float(0))# old param open left
+                        self.client.send_message("/avatar/parameters/LeftEyeLidExpandedSqueeze", float(0.8)) # open left eye
+                    if self.rb and self.lb: # If both eyes are closed, blink
+                        if self.last_blink > 0.5:
+                            self.client.send_message("/avatar/parameters/RightEyeLid", float(1)) #close eye
+                            self.client.send_message("/avatar/parameters/LeftEyeLid", float(1))
+                            self.client.send_message("/avatar/parameters/RightEyeLidExpandedSqueeze", float(0)) # close eye
+                            self.client.send_message("/avatar/parameters/LeftEyeLidExpandedSqueeze", float(0))
+                        self.last_blink = time.time() - self.last_blink
 
 
 class VRChatOSCReceiver:
@@ -181,7 +405,8 @@ class VRChatOSCReceiver:
         if osc_value:
             for eye in self.eyes:
                 eye.ransac.calibration_frame_counter = 300
-                PlaySound('Audio/start.wav', SND_FILENAME | SND_ASYNC)
+                if sys.platform.startswith("win"):
+                    PlaySound('Audio/start.wav', SND_FILENAME | SND_ASYNC)
 
     def run(self):
         
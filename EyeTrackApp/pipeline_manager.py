@@ -0,0 +1,226 @@
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from camera import Camera
+from channels import FrameRing, PreviewChannel
+from config import EyeTrackConfig, EyeTrackPipelineConfig, EyeTrackSettingsConfig
+from eye_processor import EyeProcessor
+from osc import VRChatOSC, EyeId
+from stage_timing import get_stage_timer
+
+# How often the workers report how many frames their pipelines have gotten through.
+STATS_INTERVAL = 1.0
+
+
+class PipelineResultSink:
+    # Stands in for the OSC queue inside a worker, results are tagged with the pipeline they came from.
+    def __init__(self, index, result_queue: "multiprocessing.Queue"):
+        self.index = index
+        self.result_queue = result_queue
+
+    def put(self, item, block=True, timeout=None):
+        eye_id, eye_info = item
+        self.result_queue.put(("result", self.index, eye_info))
+
+
+def run_pipeline_worker(
+    pipelines: "list[tuple[int, EyeTrackPipelineConfig]]",
+    settings: EyeTrackSettingsConfig,
+    cancellation_event: "multiprocessing.Event",
+    result_queue: "multiprocessing.Queue",
+):
+    # Entry point of a worker process. Every pipeline handed to it runs as a Camera and an EyeProcessor thread,
+    # the same as an eye does in the GUI, and results go back to the manager to be sent out over OSC.
+    threads_cancellation_event = threading.Event()
+    processors = []
+    capture_rings = []
+    threads = []
+    for index, pipeline in pipelines:
+        stage_timer = get_stage_timer(pipeline.name)
+        capture_ring = FrameRing()
+        capture_rings.append(capture_ring)
+        processor = EyeProcessor(
+            pipeline.camera,
+            settings,
+            threads_cancellation_event,
+            capture_ring,
+            # Never read, so no time goes into previews.
+            PreviewChannel(),
+            PipelineResultSink(index, result_queue),
+            pipeline.eye,
+        )
+        processor.stage_timer = stage_timer
+        camera = Camera(pipeline.camera, 0, threads_cancellation_event, queue.Queue(), capture_ring, stage_timer)
+        processors.append((index, processor))
+        threads += [threading.Thread(target=processor.run), threading.Thread(target=camera.run)]
+    for thread in threads:
+        thread.start()
+
+    while not cancellation_event.wait(STATS_INTERVAL):
+        result_queue.put(
+            (
+                "stats",
+                [
+                    (index, processor.frames_processed, capture_ring.dropped)
+                    for (index, processor), capture_ring in zip(processors, capture_rings)
+                ],
+            )
+        )
+
+    threads_cancellation_event.set()
+    for thread in threads:
+        thread.join()
+
+
+def osc_target(settings: EyeTrackSettingsConfig, pipeline: EyeTrackPipelineConfig):
+    address = pipeline.osc_address if pipeline.osc_address else settings.gui_osc_address
+    port = pipeline.osc_port if pipeline.osc_port else settings.gui_osc_port
+    return address, int(port), pipeline.osc_namespace
+
+
+class PipelineManager:
+    # Runs any number of Camera -> EyeProcessor pipelines, one per entry in config.pipelines, e.g. for a QA rig
+    # with several headsets hooked up to one machine. Pipelines are spread over a pool of worker processes, as
+    # many as there are cores (or settings.pipeline_workers), so they aren't all fighting over one GIL.
+    #
+    # Pipelines sharing an OSC target and namespace are one headset: they share a VRChatOSC, which pairs up
+    # their left and right results the same way it does for the GUI's two eyes.
+    def __init__(self, main_config: EyeTrackConfig):
+        self.main_config = main_config
+        self.settings = main_config.settings
+        self.pipelines = [
+            pipeline.copy(update={"name": pipeline.name if pipeline.name else f"pipeline{index}"})
+            for index, pipeline in enumerate(main_config.pipelines)
+            if pipeline.camera.capture_source is not None and pipeline.camera.capture_source != ""
+        ]
+
+        self.cancellation_event = multiprocessing.Event()
+        self.cancellation_event.set()
+        self.result_queue = multiprocessing.Queue()
+        self.osc_cancellation_event = threading.Event()
+        self.workers: "list[multiprocessing.Process]" = []
+        self.threads: "list[threading.Thread]" = []
+
+        # One VRChatOSC (and queue into it) per headset, and which queue each pipeline's results go on.
+        self.osc_outputs = {}
+        self.osc_queues = []
+        for pipeline in self.pipelines:
+            target = osc_target(self.settings, pipeline)
+            if target not in self.osc_outputs:
+                self.osc_outputs[target] = (queue.Queue(), [])
+            osc_queue, eyes = self.osc_outputs[target]
+            if pipeline.eye in eyes:
+                print(f"[WARN] More than one {pipeline.eye.name} eye sending to {target}, their results will mix")
+            eyes.append(pipeline.eye)
+            self.osc_queues.append(osc_queue)
+
+        self.frames = [0] * len(self.pipelines)
+        # Frames the cameras captured that their processor never got to, see FrameRing.
+        self.dropped = [0] * len(self.pipelines)
+
+    def worker_count(self):
+        workers = self.settings.pipeline_workers if self.settings.pipeline_workers > 0 else os.cpu_count() or 1
+        return max(1, min(workers, len(self.pipelines)))
+
+    def started(self):
+        return not self.cancellation_event.is_set()
+
+    def start(self):
+        if not self.cancellation_event.is_set() or len(self.pipelines) == 0:
+            return
+        self.cancellation_event.clear()
+        self.osc_cancellation_event.clear()
+
+        for (address, port, namespace), (osc_queue, eyes) in self.osc_outputs.items():
+            # Each headset gets its own copy of the settings, pointed at its target and set up for however many
+            # eyes it has, the same as the eye selection radio does in the GUI.
+            settings = self.settings.copy()
+            settings.gui_osc_address = address
+            settings.gui_osc_port = port
+            if EyeId.RIGHT in eyes and EyeId.LEFT in eyes:
+                settings.tracker_single_eye = 0
+            elif EyeId.RIGHT in eyes:
+                settings.tracker_single_eye = 2
+            else:
+                settings.tracker_single_eye = 1
+            osc = VRChatOSC(
+                self.osc_cancellation_event,
+                osc_queue,
+                self.main_config.copy(update={"settings": settings}),
+                namespace=namespace,
+            )
+            self.threads.append(threading.Thread(target=osc.run))
+
+        workers = self.worker_count()
+        indexed = list(enumerate(self.pipelines))
+        for worker in range(workers):
+            self.workers.append(
+                multiprocessing.Process(
+                    target=run_pipeline_worker,
+                    args=(indexed[worker::workers], self.settings, self.cancellation_event, self.result_queue),
+                    daemon=True,
+                )
+            )
+        self.threads.append(threading.Thread(target=self.forward_results))
+
+        for worker in self.workers:
+            worker.start()
+        for thread in self.threads:
+            thread.start()
+        print(
+            f"[INFO] Running {len(self.pipelines)} pipelines for {len(self.osc_outputs)} OSC targets "
+            f"on {workers} workers"
+        )
+
+    def stop(self):
+        if self.cancellation_event.is_set():
+            return
+        self.cancellation_event.set()
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                print("[WARN] Pipeline worker didn't exit, terminating it")
+                worker.terminate()
+        self.osc_cancellation_event.set()
+        for thread in self.threads:
+            thread.join()
+        self.workers = []
+        self.threads = []
+
+    def forward_results(self):
+        last_log_time = time.perf_counter()
+        last_frames = list(self.frames)
+        # Keeps draining until the workers are gone, they can't exit with results still waiting to be read.
+        while not self.osc_cancellation_event.is_set():
+            try:
+                message = self.result_queue.get(timeout=STATS_INTERVAL)
+            except queue.Empty:
+                message = None
+
+            if message is not None:
+                if message[0] == "result":
+                    _, index, eye_info = message
+                    self.osc_queues[index].put((self.pipelines[index].eye, eye_info))
+                elif message[0] == "stats":
+                    for index, frames, dropped in message[1]:
+                        self.frames[index] = frames
+                        self.dropped[index] = dropped
+
+            interval = self.settings.pipeline_log_interval
+            now = time.perf_counter()
+            if interval > 0 and now - last_log_time >= interval:
+                self.log_throughput(now - last_log_time, last_frames)
+                last_log_time = now
+                last_frames = list(self.frames)
+
+    def log_throughput(self, elapsed, last_frames):
+        rates = [(frames - last) / elapsed for frames, last in zip(self.frames, last_frames)]
+        per_pipeline = ", ".join(
+            f"{pipeline.name} {rate:.1f}/{dropped} dropped"
+            for pipeline, rate, dropped in zip(self.pipelines, rates, self.dropped)
+        )
+        print(
+            f"[INFO] Pipelines: {sum(rates):.1f} fps total, {sum(self.dropped)} frames dropped ({per_pipeline})"
+        )
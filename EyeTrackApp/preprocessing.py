@@ -0,0 +1,135 @@
+from collections import OrderedDict
+import math
+import numpy as np
+import cv2
+from config import EyeTrackCameraConfig
+from buffer_pool import BufferPool
+
+# Circular crop masks are cached on the sphere center and radius rounded to this many pixels, so the small
+# frame to frame jitter of the projected sphere keeps hitting the same mask.
+CIRCLE_MASK_QUANTUM = 2
+# How many circular crop masks we keep around before dropping the least recently used.
+CIRCLE_MASK_CACHE_SIZE = 8
+# How much the search window grows per pixel/frame the pupil has been moving.
+SEARCH_WINDOW_VELOCITY_GAIN = 2.0
+
+
+class CropRotate:
+    # Takes a camera frame down to the rotated gray eye image the pupil engines work on. The frame is cropped to
+    # the ROI first and converted to gray before rotating, so the rotation only has a third of the data to move.
+    # The rotation itself is baked into remap tables that are only rebuilt when the size of the crop or the
+    # rotation angle changes, and a rotation of 0 skips it altogether.
+    def __init__(self, buffers: "BufferPool" = None):
+        self.buffers = buffers if buffers is not None else BufferPool()
+        self.key = None
+        self.maps = None
+
+    def update_maps(self, rows, cols, rotation_angle):
+        key = (rows, cols, rotation_angle % 360)
+        if key == self.key:
+            return
+        self.key = key
+        if key[2] == 0:
+            self.maps = None
+            return
+
+        # Same rotation as cv2.warpAffine with getRotationMatrix2D would do, but worked out once: for every
+        # output pixel, where in the cropped image it comes from.
+        rotation_matrix = cv2.getRotationMatrix2D((cols / 2, rows / 2), rotation_angle, 1)
+        inverse = cv2.invertAffineTransform(rotation_matrix)
+        xs, ys = np.meshgrid(np.arange(cols, dtype=np.float32), np.arange(rows, dtype=np.float32))
+        map_x = (inverse[0, 0] * xs + inverse[0, 1] * ys + inverse[0, 2]).astype(np.float32)
+        map_y = (inverse[1, 0] * xs + inverse[1, 1] * ys + inverse[1, 2]).astype(np.float32)
+        # Fixed point maps are quite a bit faster to remap with than float ones.
+        self.maps = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+
+    def __call__(self, image, config: EyeTrackCameraConfig):
+        cropped = image[
+            int(config.roi_window_y): int(config.roi_window_y + config.roi_window_h),
+            int(config.roi_window_x): int(config.roi_window_x + config.roi_window_w),
+        ]
+        rows, cols = cropped.shape[:2]
+        gray = cv2.cvtColor(cropped, cv2.COLOR_BGR2GRAY, dst=self.buffers.get("gray", (rows, cols)))
+        self.update_maps(rows, cols, config.rotation_angle)
+        if self.maps is None:
+            return gray
+        # For any rotation area outside of the bounds of the image, fill with white.
+        return cv2.remap(
+            gray,
+            self.maps[0],
+            self.maps[1],
+            cv2.INTER_LINEAR,
+            dst=self.buffers.get("rotated", (rows, cols)),
+            borderMode=cv2.BORDER_CONSTANT,
+            borderValue=255,
+        )
+
+
+class CircularCrop:
+    # Whites out everything outside the projected eyeball. Masks are cached (least recently used goes first once
+    # there are more than max_masks) and applied with a single in place OR, instead of building a mask, a white
+    # image and three more images to combine them every frame.
+    def __init__(self, quantum=CIRCLE_MASK_QUANTUM, max_masks=CIRCLE_MASK_CACHE_SIZE):
+        self.quantum = quantum
+        self.max_masks = max_masks
+        self.masks = OrderedDict()
+
+    def quantize(self, value):
+        return int(round(value / self.quantum)) * self.quantum
+
+    def get_mask(self, rows, cols, cx, cy, radius):
+        key = (rows, cols, self.quantize(cx), self.quantize(cy), self.quantize(radius))
+        mask = self.masks.get(key)
+        if mask is not None:
+            self.masks.move_to_end(key)
+            return mask
+
+        # White outside the circle, black inside, so OR-ing it in leaves the eye alone and whites out the rest.
+        mask = np.full((rows, cols), 255, dtype=np.uint8)
+        cv2.circle(mask, (key[2], key[3]), key[4], 0, -1)
+        self.masks[key] = mask
+        if len(self.masks) > self.max_masks:
+            self.masks.popitem(last=False)
+        return mask
+
+    def __call__(self, gray, cx, cy, radius):
+        rows, cols = gray.shape[:2]
+        return cv2.bitwise_or(gray, self.get_mask(rows, cols, cx, cy, radius), dst=gray)
+
+
+class SearchWindow:
+    # Where to look for the pupil on the next frame. After a good detection we only search a window around it,
+    # as big as the pupil was plus a margin that grows with how fast it has been moving. A miss or a blink drops
+    # back to searching the whole ROI until the pupil is found again.
+    def __init__(self):
+        self.center = None
+        self.size = 0
+        self.velocity = 0.0
+
+    def reset(self):
+        self.center = None
+        self.velocity = 0.0
+
+    def update(self, cx, cy, w, h):
+        if not all(math.isfinite(v) for v in (cx, cy, w, h)):
+            self.reset()
+            return
+        if self.center is not None:
+            speed = math.hypot(cx - self.center[0], cy - self.center[1])
+            # Smoothed a little, a single jumpy fit shouldn't blow the window wide open.
+            self.velocity = 0.5 * self.velocity + 0.5 * speed
+        self.center = (cx, cy)
+        self.size = max(w, h)
+
+    def get(self, rows, cols, margin):
+        # Returns (x0, y0, x1, y1) to search, or None to search the whole image.
+        if self.center is None:
+            return None
+        half = self.size + margin + SEARCH_WINDOW_VELOCITY_GAIN * self.velocity
+        x0 = max(0, int(self.center[0] - half))
+        y0 = max(0, int(self.center[1] - half))
+        x1 = min(cols, int(self.center[0] + half) + 1)
+        y1 = min(rows, int(self.center[1] + half) + 1)
+        if x1 <= x0 or y1 <= y0 or (x1 - x0 >= cols and y1 - y0 >= rows):
+            return None
+        return x0, y0, x1, y1
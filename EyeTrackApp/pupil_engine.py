@@ -0,0 +1,481 @@
+from dataclasses import dataclass
+from enum import Enum
+from config import EyeTrackCameraConfig
+from config import EyeTrackSettingsConfig
+from buffer_pool import BufferPool
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+import os
+import threading
+import time
+import numpy as np
+import cv2
+
+
+class InformationOrigin(Enum):
+    RANSAC = 1
+    BLOB = 2
+    FAILURE = 3
+
+
+# How many hypotheses each worker scores at a time in parallel RANSAC. Big enough that numpy spends its time in
+# the matmul/pinv kernels (which let go of the GIL) rather than in python.
+RANSAC_BATCH_SIZE = 32
+
+
+def fit_rotated_ellipse_ransac(
+    data, iter=5, sample_num=10, offset=80, deadline=None  # 80.0, 10, 80
+):  # before changing these values, please read up on the ransac algorithm
+    # However if you want to change any value just know that higher iterations will make processing frames slower
+    count_max = 0
+    effective_sample = None
+
+    # TODO This iteration is extremely slow.
+    #
+    # Either we need to keep the iteration number low, or spread it over a worker pool, see
+    # fit_rotated_ellipse_ransac_parallel.
+    for i in range(iter):
+        # Out of time, go with the best we have so far.
+        if deadline is not None and i > 0 and time.perf_counter() > deadline:
+            break
+        sample = np.random.choice(len(data), sample_num, replace=False)
+
+        xs = data[sample][:, 0].reshape(-1, 1)
+        ys = data[sample][:, 1].reshape(-1, 1)
+
+        J = np.mat(
+            np.hstack((xs * ys, ys**2, xs, ys, np.ones_like(xs, dtype=np.float64)))
+        )
+        Y = np.mat(-1 * xs**2)
+        P = (J.T * J).I * J.T * Y
+
+        # fitter a*x**2 + b*x*y + c*y**2 + d*x + e*y + f = 0
+        a = 1.0
+        b = P[0, 0]
+        c = P[1, 0]
+        d = P[2, 0]
+        e = P[3, 0]
+        f = P[4, 0]
+        ellipse_model = (
+            lambda x, y: a * x**2 + b * x * y + c * y**2 + d * x + e * y + f
+        )
+
+        # thresh
+        ran_sample = np.array(
+            [[x, y] for (x, y) in data if np.abs(ellipse_model(x, y)) < offset]
+        )
+
+        if len(ran_sample) > count_max:
+            count_max = len(ran_sample)
+            effective_sample = ran_sample
+
+    return fit_rotated_ellipse(effective_sample)
+
+
+def score_ransac_hypotheses(data, iter, sample_num, offset):
+    # Builds and scores iter hypotheses at once, handing back the inlier count and inlier mask of the best one.
+    # Draw all of our sample sets up front. Taking the smallest sample_num keys of a random matrix per row
+    # gives us a uniform sample without replacement for each hypothesis.
+    samples = np.argpartition(np.random.random((iter, len(data))), sample_num - 1, axis=1)[:, :sample_num]
+    xs = data[samples, 0]
+    ys = data[samples, 1]
+
+    # Solve every candidate conic in a single batched least squares call.
+    # fitter a*x**2 + b*x*y + c*y**2 + d*x + e*y + f = 0
+    J = np.stack((xs * ys, ys**2, xs, ys, np.ones_like(xs)), axis=2)
+    Y = -1 * xs**2
+    P = np.matmul(np.linalg.pinv(J), Y[:, :, np.newaxis])[:, :, 0]
+
+    # Score every hull point against every candidate with one broadcast residual evaluation.
+    x = data[:, 0]
+    y = data[:, 1]
+    terms = np.stack((x * y, y**2, x, y, np.ones_like(x)), axis=0)
+    inliers = np.abs(x**2 + P @ terms) < offset
+    counts = inliers.sum(axis=1)
+
+    best = np.argmax(counts)
+    return counts[best], inliers[best]
+
+
+def fit_rotated_ellipse_ransac_batched(data, iter=100, sample_num=10, offset=80, deadline=None):
+    # Same model as fit_rotated_ellipse_ransac, but every hypothesis is built and scored at once instead of
+    # one np.mat solve and one python-level inlier scan per iteration. This keeps high iteration counts cheap
+    # enough to run at full camera rate. Everything is scored in one go, so there's no stopping part way for
+    # a deadline.
+    data = np.asarray(data, dtype=np.float64)
+    if len(data) < sample_num:
+        raise ValueError("Not enough points to sample for RANSAC")
+
+    count, inliers = score_ransac_hypotheses(data, iter, sample_num, offset)
+    if count == 0:
+        raise RuntimeError("No RANSAC inliers found")
+
+    return fit_rotated_ellipse(data[inliers])
+
+
+class RansacPool:
+    # The pool of RANSAC workers shared by every eye, kept around for as long as the app runs so nothing gets
+    # spun up per frame. 0 workers means one per core.
+    #
+    # Fits borrow the pool with lease() for as long as they're submitting to it and waiting on it. If the worker
+    # count changes a new pool takes over, and the old one is only shut down once the last fit using it has
+    # handed it back, so nobody ever submits to a pool that's been shut down.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.executor = None
+        self.workers = 0
+        # Active leases per executor, the current one and any retired ones still in use.
+        self.leases = {}
+
+    @contextmanager
+    def lease(self, workers=0):
+        workers = workers if workers > 0 else os.cpu_count() or 1
+        with self.lock:
+            if self.executor is None or self.workers != workers:
+                retired = self.executor
+                self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ransac")
+                self.workers = workers
+                self.leases[self.executor] = 0
+                if retired is not None:
+                    self.release(retired)
+            executor = self.executor
+            self.leases[executor] += 1
+        try:
+            yield executor
+        finally:
+            with self.lock:
+                self.leases[executor] -= 1
+                self.release(executor)
+
+    def release(self, executor):
+        # Shuts a retired executor down once nobody is using it any more. Called with the lock held.
+        if executor is not self.executor and self.leases[executor] == 0:
+            del self.leases[executor]
+            executor.shutdown(wait=False)
+
+
+ransac_pool = RansacPool()
+
+
+def score_ransac_batch(data, iter, sample_num, offset, deadline):
+    # Batches that only get picked up after the deadline aren't worth scoring any more.
+    if deadline is not None and time.perf_counter() > deadline:
+        return 0, None
+    return score_ransac_hypotheses(data, iter, sample_num, offset)
+
+
+def fit_rotated_ellipse_ransac_parallel(data, iter=100, sample_num=10, offset=80, deadline=None, workers=0):
+    # The batched fitter, with the hypotheses split into batches of RANSAC_BATCH_SIZE and scored on the shared
+    # worker pool. Numpy lets go of the GIL in the heavy kernels, so plain threads get the batches running on
+    # all cores. The best hypothesis of all the batches wins.
+    #
+    # With a deadline, whatever hasn't been scored by then is dropped and we go with the best so far. The first
+    # batch is always scored (on this thread, while the pool gets on with the rest), so there's always a
+    # result however tight the deadline is.
+    data = np.asarray(data, dtype=np.float64)
+    if len(data) < sample_num:
+        raise ValueError("Not enough points to sample for RANSAC")
+
+    batches = [RANSAC_BATCH_SIZE] * (iter // RANSAC_BATCH_SIZE)
+    if iter % RANSAC_BATCH_SIZE > 0:
+        batches.append(iter % RANSAC_BATCH_SIZE)
+
+    if len(batches) == 1:
+        best_count, best_inliers = score_ransac_hypotheses(data, batches[0], sample_num, offset)
+    else:
+        with ransac_pool.lease(workers) as pool:
+            futures = [
+                pool.submit(score_ransac_batch, data, size, sample_num, offset, deadline) for size in batches[1:]
+            ]
+            best_count, best_inliers = score_ransac_hypotheses(data, batches[0], sample_num, offset)
+
+            timeout = None if deadline is None else max(0.0, deadline - time.perf_counter())
+            done, not_done = wait(futures, timeout=timeout)
+            # Batches that haven't started are called off, ones already running finish on their own and are
+            # ignored.
+            for future in not_done:
+                future.cancel()
+        for future in done:
+            count, inliers = future.result()
+            if count > best_count:
+                best_count = count
+                best_inliers = inliers
+
+    if best_count == 0:
+        raise RuntimeError("No RANSAC inliers found")
+
+    return fit_rotated_ellipse(data[best_inliers])
+
+
+# Selectable through EyeTrackSettingsConfig.ransac_fitter. The reference implementation is kept around to
+# compare against, as it's the one the rest of the tracking values were tuned with.
+RANSAC_FITTERS = {
+    "reference": fit_rotated_ellipse_ransac,
+    "batched": fit_rotated_ellipse_ransac_batched,
+    "parallel": fit_rotated_ellipse_ransac_parallel,
+}
+
+
+def fit_rotated_ellipse(data):
+    xs = data[:, 0].reshape(-1, 1)
+    ys = data[:, 1].reshape(-1, 1)
+
+    J = np.mat(np.hstack((xs * ys, ys**2, xs, ys, np.ones_like(xs, dtype=np.float64))))
+    Y = np.mat(-1 * xs**2)
+    P = (J.T * J).I * J.T * Y
+
+    a = 1.0
+    b = P[0, 0]
+    c = P[1, 0]
+    d = P[2, 0]
+    e = P[3, 0]
+    f = P[4, 0]
+    theta = 0.5 * np.arctan(b / (a - c))
+
+    cx = (2 * c * d - b * e) / (b**2 - 4 * a * c)
+    cy = (2 * a * e - b * d) / (b**2 - 4 * a * c)
+
+    cu = a * cx**2 + b * cx * cy + c * cy**2 - f
+    w = np.sqrt(
+        cu
+        / (
+            a * np.cos(theta)**2
+            + b * np.cos(theta) * np.sin(theta)
+            + c * np.sin(theta)**2
+        )
+    )
+    h = np.sqrt(
+        cu
+        / (
+            a * np.sin(theta)**2
+            - b * np.cos(theta) * np.sin(theta)
+            + c * np.cos(theta)**2
+        )
+    )
+
+    ellipse_model = lambda x, y: a * x**2 + b * x * y + c * y**2 + d * x + e * y + f
+
+    error_sum = np.sum([ellipse_model(x, y) for x, y in data])
+
+    return (cx, cy, w, h, theta)
+
+
+@dataclass
+class PupilDetection:
+    # 2D result of a single engine pass. FAILURE means the engine found nothing to work with at all, a blink
+    # means it looked but nothing pupil shaped was there.
+    origin: InformationOrigin
+    threshold_image: "np.ndarray"
+    cx: float = 0
+    cy: float = 0
+    w: float = 0
+    h: float = 0
+    theta: float = 0
+    blink: bool = False
+    contours: list = None
+    bounding_rect: tuple = None
+    cost: float = 0.0
+    stage_costs: dict = None
+    # Where the image the engine worked on sits in the full eye image, see translate.
+    offset: tuple = (0, 0)
+
+    def translate(self, dx, dy):
+        # Moves a detection made on part of the eye image (the search window) back into full image coordinates.
+        # The threshold image is left as is, offset says where it goes.
+        self.cx += dx
+        self.cy += dy
+        if self.contours is not None:
+            self.contours = [contour + np.array([dx, dy], dtype=contour.dtype) for contour in self.contours]
+        if self.bounding_rect is not None:
+            (x, y, w, h) = self.bounding_rect
+            self.bounding_rect = (x + dx, y + dy, w, h)
+        self.offset = (dx, dy)
+
+
+class PupilEngine:
+    # Engines take the cropped grayscale eye image and hand back a 2D pupil ellipse. Anything 3D or
+    # calibration related is left to the EyeProcessor, so engines can be swapped per eye without touching
+    # the rest of the tracking loop.
+    name = "engine"
+    origin = InformationOrigin.FAILURE
+
+    def __init__(
+        self, config: "EyeTrackCameraConfig", settings: "EyeTrackSettingsConfig", buffers: "BufferPool" = None
+    ):
+        self.config = config
+        self.settings = settings
+        # Working images are written into the eye's buffer pool. Anything an engine hands back in a detection is
+        # only valid until the next detect call on that eye.
+        self.buffers = buffers if buffers is not None else BufferPool()
+        self.last_cost = 0.0
+        self.stage_costs = {}
+        # Set by the EyeProcessor when it's short on time (see QualityScheduler), caps ransac_iterations.
+        self.iteration_limit = None
+
+    def detect(self, frame) -> PupilDetection:
+        # Engines can break their cost down further by filling in stage_costs while they run. If they don't, the
+        # whole detect call gets reported under the engine's own name.
+        self.stage_costs = {}
+        start = time.perf_counter()
+        detection = self.find_pupil(frame)
+        # Report how long this engine took for this frame, so engines can be compared against each other.
+        detection.cost = self.last_cost = time.perf_counter() - start
+        detection.stage_costs = self.stage_costs or {self.name: detection.cost}
+        return detection
+
+    def find_pupil(self, frame) -> PupilDetection:
+        raise NotImplementedError
+
+
+class RansacPupilEngine(PupilEngine):
+    name = "ransac"
+    origin = InformationOrigin.RANSAC
+
+    def __init__(
+        self, config: "EyeTrackCameraConfig", settings: "EyeTrackSettingsConfig", buffers: "BufferPool" = None
+    ):
+        super().__init__(config, settings, buffers)
+        self.kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
+
+    def find_pupil(self, frame) -> PupilDetection:
+        # Set up thresholding. Thresholds here are basically a low-pass filter that will set any pixel < the
+        # threshold value to 0. Thresholding is user configurable in this utility as we're dealing with
+        # variable lighting amounts/placement, as well as camera positioning and lensing. Therefore
+        # everyone's cutoff may be different.
+        #
+        # The goal of thresholding settings is to make sure we can ONLY see the pupil. This is why we crop the
+        # image earlier; it gives us less possible dark area to get confused about in the next step.
+        start = time.perf_counter()
+        _, thresh = cv2.threshold(
+            frame,
+            int(self.config.threshold),
+            255,
+            cv2.THRESH_BINARY,
+            dst=self.buffers.like("threshold", frame),
+        )
+
+        # Set up morphological transforms, for smoothing and clearing the image we get out of the
+        # thresholding operation. After this, we'd really like to just have a black blob in the middle
+        # of a bunch of white area.
+        opening = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, self.kernel, dst=self.buffers.like("opening", frame))
+        closing = cv2.morphologyEx(opening, cv2.MORPH_CLOSE, self.kernel, dst=self.buffers.like("closing", frame))
+        image = cv2.bitwise_not(closing, dst=self.buffers.like("inverted", frame))
+        self.stage_costs["threshold"] = time.perf_counter() - start
+
+        # Now that the image is relatively clean, run contour finding in order to get us our pupil
+        # boundaries in the 2D context. Ideally, we just get one border.
+        # Only outer borders: holes inside the pupil (glints) are always smaller than the pupil itself, so they
+        # can never be the candidate we're after.
+        start = time.perf_counter()
+        contours, _ = cv2.findContours(image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+
+        # Find our largest hull, which we expect will probably be the ellipse that represents the 2d
+        # area for the pupil, which we can use as the search area for the eye in general. Anything smaller
+        # than the smallest blob we'd accept is noise and doesn't get a hull at all.
+        largest_hull = None
+        largest_area = -1
+        for contour in contours:
+            (_, _, w, h) = cv2.boundingRect(contour)
+            if max(w, h) < self.settings.gui_blob_minsize:
+                continue
+            hull = cv2.convexHull(contour, False)
+            area = cv2.contourArea(hull)
+            if area > largest_area:
+                largest_hull = hull
+                largest_area = area
+        self.stage_costs["contours"] = time.perf_counter() - start
+
+        # If we have no convex maidens, we have no pupil, and can't progress from here.
+        if largest_hull is None:
+            return PupilDetection(InformationOrigin.FAILURE, thresh)
+
+        start = time.perf_counter()
+        try:
+            fitter = RANSAC_FITTERS.get(self.settings.ransac_fitter, fit_rotated_ellipse_ransac_batched)
+            options = {}
+            if self.settings.ransac_time_budget > 0:
+                options["deadline"] = start + self.settings.ransac_time_budget
+            if fitter is fit_rotated_ellipse_ransac_parallel:
+                options["workers"] = self.settings.ransac_workers
+            if fitter is fit_rotated_ellipse_ransac:
+                iterations = int(self.settings.reference_ransac_iterations)
+            else:
+                iterations = int(self.settings.ransac_iterations)
+            if self.iteration_limit is not None:
+                iterations = min(iterations, self.iteration_limit)
+            cx, cy, w, h, theta = fitter(largest_hull.reshape(-1, 2), iter=iterations, **options)
+        except:
+            return PupilDetection(InformationOrigin.FAILURE, thresh)
+        finally:
+            self.stage_costs["ransac"] = time.perf_counter() - start
+
+        return PupilDetection(InformationOrigin.RANSAC, thresh, cx, cy, w, h, theta, contours=contours)
+
+
+class BlobPupilEngine(PupilEngine):
+    name = "blob"
+    origin = InformationOrigin.BLOB
+
+    def find_pupil(self, frame) -> PupilDetection:
+        _, larger_threshold = cv2.threshold(
+            frame,
+            int(self.config.threshold + 12),
+            255,
+            cv2.THRESH_BINARY,
+            dst=self.buffers.like("blob_threshold", frame),
+        )
+
+        try:
+            # Try rebuilding our contours. The pupil is dark, so look for the outer borders of the dark areas.
+            dark_areas = cv2.bitwise_not(larger_threshold, dst=self.buffers.like("blob_inverted", frame))
+            contours, _ = cv2.findContours(dark_areas, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        except:
+            return PupilDetection(InformationOrigin.FAILURE, larger_threshold)
+
+        # Nothing dark at all is what a fully closed eye looks like, that's a blink rather than a failure.
+        if len(contours) == 0:
+            return PupilDetection(InformationOrigin.BLOB, larger_threshold, blink=True)
+
+        # The largest blob whose width/height are within suitable (yet arbitrary) boundaries is our pupil.
+        # Sizes are checked first, so only those candidates get their area worked out.
+        #
+        # TODO This should be scaled based on camera resolution.
+        minsize = self.settings.gui_blob_minsize
+        maxsize = self.settings.gui_blob_maxsize
+        best = None
+        best_area = -1
+        for cnt in contours:
+            (x, y, w, h) = cv2.boundingRect(cnt)
+            if not minsize <= h <= maxsize or not minsize <= w <= maxsize:
+                continue
+            area = cv2.contourArea(cnt)
+            if area > best_area:
+                best = (cnt, (x, y, w, h))
+                best_area = area
+
+        if best is None:
+            # Nothing blob shaped in view, so the eye is most likely closed.
+            return PupilDetection(InformationOrigin.BLOB, larger_threshold, blink=True)
+
+        cnt, (x, y, w, h) = best
+        cx = x + int(w / 2)
+        cy = y + int(h / 2)
+        return PupilDetection(
+            InformationOrigin.BLOB, larger_threshold, cx, cy, w, h, contours=[cnt], bounding_rect=(x, y, w, h)
+        )
+
+
+# Selectable per eye through EyeTrackCameraConfig.pupil_engine
+PUPIL_ENGINES = {
+    "ransac": RansacPupilEngine,
+    "blob": BlobPupilEngine,
+}
+
+
+def create_pupil_engine(
+    name, config: "EyeTrackCameraConfig", settings: "EyeTrackSettingsConfig", buffers: "BufferPool" = None
+) -> PupilEngine:
+    if name not in PUPIL_ENGINES:
+        print(f"[WARN] Unknown pupil engine {name}, using ransac.")
+        name = "ransac"
+    return PUPIL_ENGINES[name](config, settings, buffers)
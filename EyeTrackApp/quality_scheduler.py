@@ -0,0 +1,113 @@
+from enum import IntEnum
+from config import EyeTrackSettingsConfig
+
+# How much each new frame moves the smoothed costs, so a single slow frame doesn't change the quality level.
+COST_SMOOTHING = 0.1
+# Quality only goes back up once frames have been taking less than this fraction of the deadline...
+STEP_UP_HEADROOM = 0.6
+# ...for this many frames in a row.
+STEP_UP_FRAMES = 60
+# Frames to leave after changing level before looking again, so the smoothed cost can catch up with it.
+SETTLE_FRAMES = 10
+# What's left of the configured RANSAC iterations and search window margin on the reduced levels.
+REDUCED_RANSAC_SCALE = 0.25
+MIN_RANSAC_ITERATIONS = 10
+REDUCED_WINDOW_SCALE = 0.5
+
+
+class QualityLevel(IntEnum):
+    # From cheapest to full quality. Every level also keeps the cutbacks of the levels above it.
+    BLOB_ONLY = 0
+    NO_CIRCULAR_CROP = 1
+    REDUCED_WINDOW = 2
+    REDUCED_RANSAC = 3
+    FULL = 4
+
+
+class QualityScheduler:
+    # Keeps one eye's frames inside a deadline when the machine can't keep up with the full pipeline. With
+    # settings.adaptive_quality on, it tracks how long frames take (capture to result) and what each stage costs
+    # against settings.frame_deadline, or one camera frame if that's 0. Running over drops a quality level:
+    # fewer RANSAC iterations, then a smaller search window, then no circular crop and finally blob tracking
+    # only. Once there's been plenty of headroom for a while it steps back up again, one level at a time.
+    #
+    # The EyeProcessor asks it what to do for each of those, and the level a result was tracked at goes out
+    # with it in EyeInformation.
+    def __init__(self, name, settings: EyeTrackSettingsConfig):
+        self.name = name
+        self.settings = settings
+        self.level = QualityLevel.FULL
+        self.frame_cost = None
+        self.stage_costs = {}
+        self.frames_under = 0
+        self.settle_frames = 0
+
+    def record(self, stage, seconds):
+        previous = self.stage_costs.get(stage)
+        self.stage_costs[stage] = seconds if previous is None else previous + COST_SMOOTHING * (seconds - previous)
+
+    def deadline(self, fps):
+        if self.settings.frame_deadline > 0:
+            return self.settings.frame_deadline
+        if fps is not None and fps > 0:
+            return 1 / fps
+        return None
+
+    def update(self, frame_cost, fps):
+        if not self.settings.adaptive_quality:
+            if self.level != QualityLevel.FULL:
+                self.level = QualityLevel.FULL
+                self.frame_cost = None
+            return self.level
+
+        deadline = self.deadline(fps)
+        if deadline is None:
+            return self.level
+        if self.frame_cost is None:
+            self.frame_cost = frame_cost
+        else:
+            self.frame_cost += COST_SMOOTHING * (frame_cost - self.frame_cost)
+
+        if self.settle_frames > 0:
+            self.settle_frames -= 1
+        elif self.frame_cost > deadline:
+            self.frames_under = 0
+            if self.level > QualityLevel.BLOB_ONLY:
+                self.change_level(QualityLevel(self.level - 1), deadline)
+        elif self.frame_cost < deadline * STEP_UP_HEADROOM and self.level < QualityLevel.FULL:
+            self.frames_under += 1
+            if self.frames_under >= STEP_UP_FRAMES:
+                self.change_level(QualityLevel(self.level + 1), deadline)
+        else:
+            self.frames_under = 0
+        return self.level
+
+    def change_level(self, level, deadline):
+        stages = ", ".join(
+            f"{stage} {cost * 1000:.1f}ms"
+            for stage, cost in sorted(self.stage_costs.items(), key=lambda item: item[1], reverse=True)[:3]
+        )
+        print(
+            f"[INFO] {self.name} quality {self.level.name} -> {level.name}, frames taking "
+            f"{self.frame_cost * 1000:.1f}ms against a {deadline * 1000:.1f}ms deadline ({stages})"
+        )
+        self.level = level
+        self.frames_under = 0
+        self.settle_frames = SETTLE_FRAMES
+
+    def ransac_iteration_limit(self):
+        # None means no limit, use ransac_iterations as configured.
+        if self.level > QualityLevel.REDUCED_RANSAC:
+            return None
+        return max(MIN_RANSAC_ITERATIONS, int(self.settings.ransac_iterations * REDUCED_RANSAC_SCALE))
+
+    def search_window_margin(self):
+        if self.level > QualityLevel.REDUCED_WINDOW:
+            return self.settings.search_window_margin
+        return int(self.settings.search_window_margin * REDUCED_WINDOW_SCALE)
+
+    def circular_crop(self):
+        return self.level > QualityLevel.NO_CIRCULAR_CROP
+
+    def blob_only(self):
+        return self.level == QualityLevel.BLOB_ONLY
@@ -5,11 +5,12 @@ from eye_processor import EyeProcessor, InformationOrigin
 from enum import Enum
 from queue import Queue, Empty
 from camera import Camera, CameraState
+from channels import ControlChannel, ControlCommand, ControlMessage
 import cv2
 from osc import EyeId
 
 class SettingsWidget:
-    def __init__(self, widget_id: EyeId, main_config: EyeTrackSettingsConfig, osc_queue: Queue):
+    def __init__(self, widget_id: EyeId, main_config: EyeTrackSettingsConfig, control_channel: ControlChannel):
 
         self.gui_flip_x_axis_left = f"-FLIPXAXISLEFT{widget_id}-"
         self.gui_flip_x_axis_right = f"-FLIPXAXISRIGHT{widget_id}-"
@@ -29,7 +30,7 @@ class SettingsWidget:
         self.gui_blink_sync = f"-BLINKSYNC{widget_id}-"
         self.main_config = main_config
         self.config = main_config.settings
-        self.osc_queue = osc_queue
+        self.control_channel = control_channel
 
         # Define the window's contents
         self.general_settings_layout = [
@@ -253,5 +254,4 @@ class SettingsWidget:
 
         if changed:
             self.main_config.save()
-            
-        self.osc_queue.put((EyeId.SETTINGS))
+            self.control_channel.publish(ControlMessage(ControlCommand.SETTINGS_CHANGED))
@@ -0,0 +1,88 @@
+from contextlib import contextmanager
+from collections import deque
+import threading
+import time
+import numpy as np
+
+# How many samples per stage we keep around for the rolling percentiles.
+TIMING_WINDOW = 1000
+
+
+class StageTimer:
+    # Rolling per stage timings for a single eye. Stages are recorded from whichever thread runs them (capture,
+    # processing, OSC), so everything goes through a lock.
+    def __init__(self, name, window=TIMING_WINDOW):
+        self.name = name
+        self.window = window
+        self.samples = {}
+        # Running totals that go out with the timings, e.g. frames the processor didn't get to in time.
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.last_log_time = time.perf_counter()
+
+    def record(self, stage, seconds):
+        with self.lock:
+            if stage not in self.samples:
+                self.samples[stage] = deque(maxlen=self.window)
+            self.samples[stage].append(seconds)
+
+    @contextmanager
+    def measure(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def set_counter(self, name, value):
+        with self.lock:
+            self.counters[name] = value
+
+    def get_counters(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def percentiles(self):
+        # Returns {stage: (p50, p95, p99)} in seconds, over the last TIMING_WINDOW samples of each stage.
+        with self.lock:
+            samples = {stage: np.array(values) for stage, values in self.samples.items() if len(values) > 0}
+        return {stage: tuple(np.percentile(values, (50, 95, 99))) for stage, values in samples.items()}
+
+    def reset(self):
+        with self.lock:
+            self.samples.clear()
+            self.counters.clear()
+
+    def maybe_log(self, interval):
+        # Print a summary line every interval seconds. An interval of 0 or less turns logging off.
+        if interval <= 0:
+            return
+        now = time.perf_counter()
+        if now - self.last_log_time < interval:
+            return
+        self.last_log_time = now
+        counters = "".join(f" | {name} {value}" for name, value in self.get_counters().items())
+        print(f"[INFO] {self.name} stage timings (ms p50/p95/p99): {format_percentiles(self.percentiles())}{counters}")
+
+
+def format_percentiles(percentiles):
+    return " | ".join(
+        f"{stage} {p50 * 1000:.2f}/{p95 * 1000:.2f}/{p99 * 1000:.2f}" for stage, (p50, p95, p99) in percentiles.items()
+    )
+
+
+_stage_timers = {}
+_stage_timers_lock = threading.Lock()
+
+
+def get_stage_timer(name) -> StageTimer:
+    # One timer per eye, shared by the camera, processor and OSC threads working on that eye.
+    with _stage_timers_lock:
+        if name not in _stage_timers:
+            _stage_timers[name] = StageTimer(name)
+        return _stage_timers[name]
+
+
+def stage_timers():
+    with _stage_timers_lock:
+        return dict(_stage_timers)
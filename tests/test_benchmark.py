@@ -0,0 +1,40 @@
+import json
+import os
+import subprocess
+import sys
+import pytest
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "EyeTrackApp")
+
+
+def write_clip(path, frames=10, size=64):
+    cv2 = pytest.importorskip("cv2")
+    np = pytest.importorskip("numpy")
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"MJPG"), 30, (size, size))
+    for i in range(frames):
+        # A dark pupil drifting around on a white eye.
+        frame = np.full((size, size, 3), 255, dtype=np.uint8)
+        cv2.circle(frame, (size // 2 + i % 3, size // 2), size // 8, (0, 0, 0), -1)
+        writer.write(frame)
+    writer.release()
+
+
+def test_benchmark_runs_a_few_frames(tmp_path):
+    # Runs benchmark.py the way it's run by hand, as its own process, so import problems show up too.
+    for module in ("cv2", "numpy", "pydantic", "pythonosc"):
+        pytest.importorskip(module)
+    clip_dir = tmp_path / "clips"
+    clip_dir.mkdir()
+    write_clip(clip_dir / "eye.avi")
+    output = tmp_path / "bench.json"
+
+    subprocess.run(
+        [sys.executable, "benchmark.py", str(clip_dir), "--output", str(output), "--max-frames", "5"],
+        cwd=APP_DIR,
+        check=True,
+        timeout=120,
+    )
+
+    results = json.loads(output.read_text())
+    assert len(results["clips"]) == 1
+    assert results["clips"][0]["frames"] == 5